@@ -20,14 +20,21 @@
 import sys
 import argparse
 import logging
+import ipaddress
+import concurrent.futures
+import multiprocessing
 import colorlog
 import miner
 import os
 
 import miner.dodo
+import miner.nand as nand
 
 from doit.cmd_base import ModuleTaskLoader
 from doit.doit_cmd import DoitMain
+from collections import OrderedDict
+
+PLATFORMS = ['zynq-dm1-g9', 'zynq-dm1-g19', 'zynq-am1-s9']
 
 
 class CommandManager:
@@ -42,28 +49,45 @@ class CommandManager:
     def set_args(self, argv, args):
         self._argv = argv
         self._args = args
-        self._config = miner.load_config(args.config)
+        config = miner.load_config(args.config)
+
+        # overload settings with local configuration
+        if os.path.isfile(self.LOCAL_CONFIGURATION):
+            config = config.overlay()
+            config.merge(miner.load_config(self.LOCAL_CONFIGURATION))
+
+        # command line options are stored in separate layer
+        self._config = config.overlay()
 
         # set optional keys to default value
         self._config.setdefault('build.jobs', 1)
         self._config.setdefault('build.verbose', 'no')
         self._config.setdefault('remote.fetch', 'no')
         self._config.setdefault('remote.fetch_always', 'no')
+        self._config.setdefault('remote.jobs', 1)
         self._config.setdefault('uenv.mac', 'yes')
         self._config.setdefault('uenv.factory_reset', 'no')
         self._config.setdefault('uenv.sd_images', 'no')
         self._config.setdefault('uenv.sd_boot', 'no')
 
-        # overload settings with local configuration
-        if os.path.isfile(self.LOCAL_CONFIGURATION):
-            config_local = miner.load_config(self.LOCAL_CONFIGURATION)
-            self._config.merge(config_local)
-
         # change default platform in configuration
         if args.platform:
             self._config.miner.platform = args.platform
+        # each platform uses its own build directory
+        if args.separate_dirs:
+            self._config.build.name = '{}-{{subtarget}}'.format(self._config.build.name)
 
-    def _doit_prepare(self, builder, task):
+    def _doit_prepare(self, builder, *tasks, single=False):
+        """
+        Run doit tasks for preparation of the build directory
+
+        :param builder:
+            Miner builder for current configuration.
+        :param tasks:
+            Names of doit tasks.
+        :param single:
+            Run only specified tasks in given order without their dependencies.
+        """
         miner.dodo.builder = builder
 
         # create build directory for storing doit database
@@ -75,8 +99,20 @@ class CommandManager:
                              extra_config={'GLOBAL': opt_vals})
         commander.BIN_NAME = 'doit'
 
+        doit_args = ['--verbosity', '2']
+        jobs = self._config.remote.jobs
+        if jobs > 1 and not single:
+            # independent tasks are run in threads because most of the time is spent in git subprocesses
+            doit_args.extend(['-n', str(jobs), '-P', 'thread'])
+
         logging.info('Preparing LEDE build system...')
-        commander.run(['--verbosity', '2', task])
+        if not single:
+            commander.run(doit_args + list(tasks))
+            return
+        # doit runs only the first of more tasks selected without dependencies so they are run one by one
+        for task in tasks:
+            if commander.run(doit_args + ['--single', task]) != 0:
+                raise miner.BuilderStop
 
     def get_builder(self, task=None):
         """
@@ -89,6 +125,8 @@ class CommandManager:
 
     def prepare(self):
         logging.debug("Called command 'prepare'")
+        if self._args.jobs:
+            self._config.remote.jobs = self._args.jobs
         if self._args.fetch:
             self._config.remote.fetch_always = 'yes'
             self.get_builder('checkout')
@@ -118,10 +156,103 @@ class CommandManager:
             self._config.build.jobs = self._args.jobs
         if self._args.verbose:
             self._config.build.verbose = 'yes'
+        if self._args.update_feeds:
+            self._config.feeds.update_always = 'yes'
+
+        if self._args.platforms:
+            if self._args.platform:
+                logging.error("Option '--platforms' cannot be combined with '--platform'")
+                raise miner.BuilderStop
+            self._build_matrix(self._get_platforms(self._args.platforms))
+            return
 
         builder = self.get_builder('prepare')
         builder.build(targets=self._args.target)
 
+    @staticmethod
+    def _get_platforms(platforms):
+        """
+        Return list of unique platforms from comma separated list
+        """
+        platforms = [platform.strip() for platform in platforms.split(',')]
+        platforms = list(OrderedDict.fromkeys(platform for platform in platforms if platform))
+        unsupported = [platform for platform in platforms if platform not in PLATFORMS]
+        if unsupported or not platforms:
+            logging.error("Unsupported platforms '{}' (choose from {})"
+                          .format(','.join(unsupported), ', '.join(PLATFORMS)))
+            raise miner.BuilderStop
+        return platforms
+
+    def _build_group(self, configs):
+        """
+        Build platforms which share one build directory one by one
+
+        Repositories, feeds, host tools and toolchain are prepared only once for the first platform. The following
+        platforms only switch repositories which differ and generate their own LEDE configuration.
+        """
+        previous = None
+        for config in configs:
+            logging.info("Building platform '{}'...".format(config.miner.platform))
+            builder = miner.Builder(config, self._argv)
+            if not previous:
+                self._doit_prepare(builder, 'prepare')
+                builder.build_tools()
+            else:
+                self._doit_prepare(builder, *builder.get_platform_tasks(previous), single=True)
+            builder.build(targets=self._args.target)
+            previous = builder
+
+    def _build_matrix(self, platforms):
+        """
+        Build more platforms in one run
+
+        Platforms with the same build directory are built one after another and they share repositories, feeds, host
+        tools and toolchain. Groups of platforms with different build directories are built concurrently in separate
+        processes and the number of jobs is split between them.
+        """
+        groups = OrderedDict()
+        for platform in platforms:
+            # each platform has its own copy-on-write configuration
+            config = self._config.overlay()
+            config.miner.platform = platform
+            build_dir = miner.Builder(config, self._argv).build_dir
+            groups.setdefault(build_dir, []).append(config)
+
+        jobs = int(self._config.build.jobs)
+        for i, configs in enumerate(groups.values()):
+            # remaining jobs are assigned to the first groups
+            group_jobs = max(1, jobs // len(groups) + (1 if i < jobs % len(groups) else 0))
+            for config in configs:
+                config.build.jobs = group_jobs
+
+        if len(groups) == 1:
+            self._build_group(next(iter(groups.values())))
+            return
+
+        def run_group(configs):
+            try:
+                self._build_group(configs)
+            except miner.BuilderStop:
+                sys.exit(1)
+
+        # each doit run needs its own process because the builder is stored in module global variable
+        processes = OrderedDict()
+        for build_dir, configs in groups.items():
+            logging.info("Building {} in '{}'...".format(', '.join(config.miner.platform for config in configs),
+                                                         build_dir))
+            process = multiprocessing.get_context('fork').Process(target=run_group, args=(configs,))
+            process.start()
+            processes[build_dir] = process
+
+        failed = False
+        for build_dir, process in processes.items():
+            process.join()
+            if process.exitcode != 0:
+                logging.error("Build in '{}' failed".format(build_dir))
+                failed = True
+        if failed:
+            raise miner.BuilderStop
+
     def build_version(self):
         logging.debug("Called command 'build-version'")
         builder = self.get_builder()
@@ -169,8 +300,67 @@ class CommandManager:
                         setattr(local, target + '_config', path)
                     setattr(local, target, path)
 
+        hosts = self._get_hosts(self._args.hosts) if self._args.hosts else None
+        if hosts and (self._args.mac or self._args.hostname):
+            logging.error("Option '--hosts' cannot be combined with '--mac' or '--hostname'")
+            raise miner.BuilderStop
+
         builder = self.get_builder()
-        builder.deploy()
+        builder.deploy(hosts=hosts, parallel=self._args.parallel)
+
+    @staticmethod
+    def _get_hosts(hosts):
+        """
+        Return list of remote hosts from file with one host per line or from IP subnetwork
+        """
+        if os.path.isfile(hosts):
+            with open(hosts, 'r') as hosts_file:
+                return [line.strip() for line in hosts_file if line.strip() and not line.startswith('#')]
+        try:
+            return [str(host) for host in ipaddress.ip_network(hosts, strict=False).hosts()]
+        except ValueError:
+            logging.error("Hosts '{}' is neither a file nor an IP subnetwork".format(hosts))
+            raise miner.BuilderStop
+
+    def miner_cfg(self):
+        logging.debug("Called command 'miner-cfg'")
+        try:
+            miners = nand.load_inventory(self._args.inventory)
+        except (OSError, ValueError) as e:
+            logging.error("Cannot load inventory '{}': {}".format(self._args.inventory, e))
+            raise miner.BuilderStop
+
+        defaults = nand.get_miner_cfg_defaults(self._config)
+        failed = 0
+        with concurrent.futures.ProcessPoolExecutor(max_workers=self._args.jobs) as executor:
+            futures = {}
+            for miner_config in miners:
+                if 'net.mac' not in miner_config:
+                    logging.error("Missing MAC address for miner '{}'".format(miner_config))
+                    failed += 1
+                    continue
+                name = nand.get_miner_name(miner_config)
+                target_dir = os.path.join(self._args.output, name)
+                # HW identifier is generated by each worker so every miner gets a new one
+                future = executor.submit(nand.write_miner_cfg_files, dict(defaults, **miner_config), target_dir)
+                futures[future] = name
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    result = future.result()
+                except Exception as e:
+                    # error of one miner does not stop the others
+                    logging.error("Cannot create miner configuration for '{}': {}".format(futures[future], e))
+                    result = False
+                if result:
+                    logging.debug("Created miner configuration for '{}'".format(futures[future]))
+                else:
+                    failed += 1
+
+        logging.info("Created miner configuration for {} miners in '{}'".format(len(miners) - failed,
+                                                                             self._args.output))
+        if failed:
+            logging.error("Miner configuration failed for {} miners".format(failed))
+            raise miner.BuilderStop
 
     def status(self):
         logging.debug("Called command 'status'")
@@ -193,7 +383,8 @@ class CommandManager:
             # always fetch all repositories before creating release
             self._config.remote.fetch_always = 'yes'
 
-        config_original = miner.load_config(self._args.config)
+        # comments and formatting have to be preserved for dump of release configuration
+        config_original = miner.load_config(self._args.config, round_trip=True)
         builder = self.get_builder('checkout')
         builder.release(config_original, push=not self._args.no_push)
 
@@ -223,6 +414,8 @@ def main(argv):
                            help='force to fetch all repositories')
     subparser.add_argument('--update-feeds', action='store_true',
                            help='force to update all feeds')
+    subparser.add_argument('-j', '--jobs', type=int,
+                           help='number of repositories cloned and checked out simultaneously')
 
     # create the parser for the "clean" command
     subparser = subparsers.add_parser('clean',
@@ -249,6 +442,10 @@ def main(argv):
     subparser.add_argument('-k', '--key',
                            help='specify path to build key in a format <secret>[:<public>]; '
                                 'when the <public> key is omitted then <secret>.pub is used')
+    subparser.add_argument('--update-feeds', action='store_true',
+                           help='force to update all feeds')
+    subparser.add_argument('--platforms',
+                           help='build all platforms from comma separated list in one run')
     subparser.add_argument('target', nargs='*',
                            help='build only specific targets when specified')
 
@@ -267,6 +464,11 @@ def main(argv):
                            help='MAC address of miner (it is also used for remote host name determination)')
     subparser.add_argument('--hostname', nargs='?',
                            help='ip address or hostname of remote miner with ssh server')
+    subparser.add_argument('--hosts',
+                           help='deploy the same image to many miners listed in a file (one host per line) '
+                                'or to all hosts in IP subnetwork')
+    subparser.add_argument('--parallel', type=int, default=8,
+                           help='number of miners deployed simultaneously with --hosts')
     subparser.add_argument('--pool-url', nargs='?',
                            help='address of pool server in a format <host>[:<port>]')
     subparser.add_argument('--pool-user', nargs='?',
@@ -280,6 +482,17 @@ def main(argv):
                            help='list of targets for deployment (local target can specify also output directory '
                                 'in a format <target>[:<path>])')
 
+    # create the parser for the "miner-cfg" command
+    subparser = subparsers.add_parser('miner-cfg',
+                                      help="generate miner configuration images for all miners in inventory")
+    subparser.set_defaults(func=command.miner_cfg)
+    subparser.add_argument('-o', '--output', default='miner_cfg',
+                           help='output directory with subdirectory for each miner')
+    subparser.add_argument('-j', '--jobs', type=int,
+                           help='number of processes generating configuration (default is number of CPUs)')
+    subparser.add_argument('inventory',
+                           help='CSV or YAML file with miners (columns {})'.format(', '.join(nand.INVENTORY_COLUMNS)))
+
     # create the parser for the "status" command
     subparser = subparsers.add_parser('status',
                                       help="show status of LEDE repository and all dependent projects")
@@ -318,8 +531,11 @@ def main(argv):
                         help='logging level')
     parser.add_argument('--config', default=miner.DEFAULT_CONFIG,
                         help='path to configuration file')
-    parser.add_argument('--platform', choices=['zynq-dm1-g9', 'zynq-dm1-g19', 'zynq-am1-s9'], nargs='?',
+    parser.add_argument('--platform', choices=PLATFORMS, nargs='?',
                         help='change default miner platform')
+    parser.add_argument('--separate-dirs', action='store_true',
+                        help='use separate build directory for each platform so that build with --platforms runs '
+                             'all of them concurrently')
 
     # parse command line arguments
     args = parser.parse_args(argv)
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+
+# Copyright (C) 2018  Braiins Systems s.r.o.
+#
+# This file is part of Braiins Build System (BB).
+#
+# BB is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Benchmark of configuration access patterns used by the builder
+
+The configuration is loaded from the default configuration file and it has the same format tags as the builder. Run it
+from the repository root with:
+
+    python3 -m benchmarks.config_access
+"""
+
+import argparse
+import timeit
+
+from miner.config import TagFormatter, load_config
+
+
+def get_config(path):
+    config = load_config(path)
+    platform = config.miner.platform
+    target, subtarget = platform.split('-', 1)
+    config.formatter = TagFormatter({
+        'meta_repo': 'https://github.com/braiins',
+        'meta_branch': 'master',
+        'platform': platform,
+        'target': target,
+        'subtarget': subtarget,
+        'subtarget_family': subtarget.split('-')[0]
+    })
+    config.formatter.add_tag('build_dir', '/tmp/build')
+    return config
+
+
+def attribute_access(config):
+    # deploy steps read the same options over and over
+    config.miner.platform
+    config.net.mac
+    config.deploy.reset_uboot_env
+    config.deploy.write_miner_cfg
+    config.build.name
+
+
+def path_access(config):
+    config.uenv.get('sd_boot')
+    config.deploy.ssh.get('hostname')
+    config.get('build.jobs')
+    config.get('miner.pool.host')
+    config.get('local.sd')
+
+
+def formatted_access(config):
+    config.local.sd
+    config.local.upgrade
+    config.local.feeds
+
+
+def remote_walk(config):
+    for name, repo in config.remote.repos.items():
+        repo.get('location')
+        repo.get('branch')
+
+
+BENCHMARKS = [
+    ('attribute access', attribute_access),
+    ('path access', path_access),
+    ('formatted access', formatted_access),
+    ('remote walk', remote_walk)
+]
+
+
+def main(args):
+    config = get_config(args.config)
+    for name, benchmark in BENCHMARKS:
+        best = min(timeit.repeat(lambda: benchmark(config), number=args.number, repeat=args.rounds))
+        print('{:20} {:8.2f}us/call'.format(name, best / args.number * 1e6))
+
+
+if __name__ == "__main__":
+    # execute only if run as a script
+    parser = argparse.ArgumentParser(description='Benchmark of configuration access patterns')
+    parser.add_argument('--config', default='configs/default.yml',
+                        help='path to configuration file')
+    parser.add_argument('--number', type=int, default=10000,
+                        help='number of calls in one round')
+    parser.add_argument('--rounds', type=int, default=5,
+                        help='number of benchmark rounds')
+    main(parser.parse_args())
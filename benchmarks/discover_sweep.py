@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+
+# Copyright (C) 2018  Braiins Systems s.r.o.
+#
+# This file is part of Braiins Build System (BB).
+#
+# BB is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Benchmark of SSH port sweep used by discover.py
+
+The fake subnet is made of listeners on loopback addresses 127.0.x.y. Only every n-th host has an open port so the rest
+of hosts refuses connection. Run it from the repository root with:
+
+    python3 -m benchmarks.discover_sweep
+"""
+
+import argparse
+import asyncio
+import socket
+import time
+
+from discover import PortSweeper
+
+
+async def probe_open_connection(hostname, port, timeout):
+    """
+    Reference probe with stream API used by previous implementation of discover.py
+    """
+    try:
+        _, writer = await asyncio.wait_for(asyncio.open_connection(hostname, port), timeout=timeout)
+    except (asyncio.TimeoutError, OSError):
+        return False
+    writer.close()
+    return True
+
+
+def get_hostnames(count):
+    return ['127.0.{}.{}'.format(i // 250, i % 250 + 1) for i in range(count)]
+
+
+def create_listeners(hostnames, port):
+    listeners = []
+    for hostname in hostnames:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((hostname, port))
+        sock.listen(128)
+        listeners.append(sock)
+    return listeners
+
+
+async def sweep(probe, hostnames, jobs):
+    semaphore = asyncio.Semaphore(jobs)
+
+    async def probe_host(hostname):
+        async with semaphore:
+            return await probe(hostname)
+
+    return sum(await asyncio.gather(*(probe_host(hostname) for hostname in hostnames)))
+
+
+def measure(loop, name, probe, hostnames, jobs):
+    start = time.monotonic()
+    found = loop.run_until_complete(sweep(probe, hostnames, jobs))
+    elapsed = time.monotonic() - start
+    print('{:16} {:6d} hosts {:5d} open {:8.3f}s {:10.1f} hosts/s'.format(
+        name, len(hostnames), found, elapsed, len(hostnames) / elapsed))
+
+
+def main(args):
+    hostnames = get_hostnames(args.hosts)
+    listeners = create_listeners(hostnames[::args.open_every], args.port)
+    loop = asyncio.get_event_loop()
+    sweeper = PortSweeper(args.port, args.timeout)
+    try:
+        for _ in range(args.rounds):
+            measure(loop, 'open_connection', lambda hostname: probe_open_connection(hostname, args.port, args.timeout),
+                    hostnames, args.jobs)
+            measure(loop, 'PortSweeper', sweeper.probe, hostnames, args.jobs)
+        print('adapted timeout: {:.1f}ms'.format(sweeper.timeout * 1000))
+    finally:
+        for sock in listeners:
+            sock.close()
+
+
+if __name__ == "__main__":
+    # execute only if run as a script
+    parser = argparse.ArgumentParser(description='Benchmark of SSH port sweep on a fake loopback subnet')
+    parser.add_argument('--hosts', type=int, default=5000,
+                        help='number of hosts in the fake subnet')
+    parser.add_argument('--open-every', type=int, default=10,
+                        help='every n-th host has open port')
+    parser.add_argument('--port', type=int, default=2222,
+                        help='port of listeners')
+    parser.add_argument('--timeout', type=float, default=0.5,
+                        help='initial probe timeout')
+    parser.add_argument('--jobs', type=int, default=500,
+                        help='number of concurrent probes')
+    parser.add_argument('--rounds', type=int, default=3,
+                        help='number of benchmark rounds')
+    main(parser.parse_args())
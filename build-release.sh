@@ -76,24 +76,28 @@ fi
 # get build version for current branch
 version=$(./bb.py build-version)
 
-# Iterate all releases/switch repo and build
+release_platforms=$(printf "$target-%s," $release_subtargets)
+
+# each platform has its own build directory so all platforms are built concurrently and
+# deploy of one platform never reads packages or images overwritten by build of another one
+bb_opts=--separate-dirs
+
+if [ $STAGE1 = y ]; then
+    # build everything for all platforms in one run
+    $DRY_RUN ./bb.py $bb_opts build --update-feeds --key $key -j$parallel_jobs -v --platforms ${release_platforms%,}
+fi
+
+# Iterate all releases and deploy
 for subtarget in $release_subtargets; do
     # latest release
     platform=$target-$subtarget
-    # We need to ensure that feeds are update
-    if [ $STAGE1 = y ]; then
-	$DRY_RUN ./bb.py --platform $platform prepare
-	$DRY_RUN ./bb.py --platform $platform prepare --update-feeds
-	# build everything for a particular platform
-	$DRY_RUN ./bb.py --platform $platform build --key $key -j$parallel_jobs -v
-    fi
 
     package_name=${fw_prefix}_${subtarget}_${version}
     platform_dir=$output_dir/$package_name
 
     # Deploy SD and upgrade images
     for i in sd upgrade; do
-	$DRY_RUN ./bb.py --platform $platform deploy local_$i:$platform_dir/$i --pool-user $pool_user
+	$DRY_RUN ./bb.py $bb_opts --platform $platform deploy local_$i:$platform_dir/$i --pool-user $pool_user
     done
 
     # Feeds deploy is specially handled as it has to merge with firmware packages
@@ -106,7 +110,7 @@ for subtarget in $release_subtargets; do
 	echo Nothing has been published for $platform, skipping merge of Packages...
 	extra_feeds_opts=
     fi
-    $DRY_RUN ./bb.py --platform $platform deploy local_feeds:$platform_dir/feeds $extra_feeds_opts --pool-user $pool_user
+    $DRY_RUN ./bb.py $bb_opts --platform $platform deploy local_feeds:$platform_dir/feeds $extra_feeds_opts --pool-user $pool_user
 
     # Generate script for publication
     ($DRY_RUN cd $output_dir;
@@ -18,18 +18,85 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import argparse
+import errno
+import csv
 import itertools
 import ipaddress
 import asyncssh
 import asyncio
+import collections
+import resource
+import socket
+import hashlib
+import sqlite3
 import json
+import time
+import os
 import sys
 
-from asyncssh import create_connection
 from asyncssh.misc import async_context_manager
 
+from ssh_async import try_password, race_passwords
+
 ALL_HOSTS = '*'
 
+DEFAULT_CREDENTIALS_CACHE = os.path.join(os.path.expanduser('~'), '.cache', 'bos-discover', 'credentials.json')
+
+# marker delimiting output of particular commands in the batch script
+BATCH_MARKER = '@@bos-discover@@'
+BATCH_TIMEOUT = 5
+
+# guard for commands which make sense only on bOS
+BATCH_GUARD_BOS = '[ -f /tmp/sysinfo/board_name ]'
+
+# files which change when firmware, configuration or network settings of any supported device are changed
+FINGERPRINT_FILES = [
+    '/tmp/sysinfo/board_name', '/etc/bos_version', '/etc/bos_mode', '/etc/bos_note', '/etc/config/network',
+    '/etc/cgminer.conf', '/usr/bin/ctrl_bd', '/usr/bin/compile_time', '/config/network.conf', '/config/note',
+    '/config/bmminer.conf', '/tmp/hwver', '/etc/hwrevision', '/config/network/25-wired.network'
+]
+
+# cheap command for incremental scan which prints MAC address on the first line followed by fingerprint of the device
+FINGERPRINT_COMMAND = "cat /sys/class/net/eth0/address; md5sum {} 2>/dev/null; grep ' /overlay ' /proc/mounts".format(
+    ' '.join(FINGERPRINT_FILES))
+
+# list of all commands used for device detection with an optional shell condition
+# the command strings must be the same as the ones used by info classes otherwise they are run separately
+BATCH_COMMANDS = [
+    # NetworkInfo
+    ("cat /sys/class/net/eth0/address", None),
+    ("/sbin/ip route get 1 | awk '{print $NF;exit}'", None),
+    # DeviceInfo
+    ("grep MemTotal /proc/meminfo | awk '{print $2\" \"$3}'", None),
+    ("cat /etc/cgminer.conf", None),
+    # OpenWrtNetInfo
+    ('uci show network.lan | sed "1d;s/network.lan.//;s/\'//g"', BATCH_GUARD_BOS),
+    ('cat /proc/sys/kernel/hostname', None),
+    # AmNetInfo
+    ('cat /config/network.conf', None),
+    # DmNetInfo
+    ('cat /config/network/25-wired.network', None),
+    ('hostname', None),
+    # BosInfo
+    ("cat /tmp/sysinfo/board_name", None),
+    ("cat /etc/bos_version", None),
+    ("opkg list-installed | sed -n '/firmware/s/.*- //p'", BATCH_GUARD_BOS + ' && [ ! -s /etc/bos_version ]'),
+    ("mount | grep -q '/dev/ubi0_2 on /overlay'", BATCH_GUARD_BOS),
+    ("mount | grep -q '/dev/mmcblk0p2 on /overlay'", BATCH_GUARD_BOS),
+    ("cat /etc/bos_mode", None),
+    ('cat /etc/bos_note', None),
+    # AmInfo
+    ("cat /usr/bin/ctrl_bd", None),
+    ("cat /usr/bin/compile_time", None),
+    ('cat /config/note', None),
+    ("cat /config/bmminer.conf", None),
+    # DmInfo
+    ("cat /tmp/hwver", None),
+    ("cat /etc/hwrevision", None),
+    # Inventory
+    (FINGERPRINT_COMMAND, None)
+]
+
 
 class NetworkInfo:
     PROTO_DHCP = 'dhcp'
@@ -52,6 +119,15 @@ class NetworkInfo:
     async def _get_ip(self, conn):
         return await asyncssh_run(conn, "/sbin/ip route get 1 | awk '{print $NF;exit}'")
 
+    def to_dict(self):
+        return dict(vars(self))
+
+    @staticmethod
+    def from_dict(data):
+        net = NetworkInfo()
+        vars(net).update(data)
+        return net
+
 
 class PoolInfo:
     def __init__(self, url, user, pwd):
@@ -59,6 +135,13 @@ class PoolInfo:
         self.user = user
         self.pwd = pwd
 
+    def to_dict(self):
+        return dict(vars(self))
+
+    @staticmethod
+    def from_dict(data):
+        return PoolInfo(data['url'], data['user'], data['pwd'])
+
 
 class DeviceInfo:
     INFO_UNKNOWN = 'unknown'
@@ -146,6 +229,35 @@ class DeviceInfo:
         self.note and info.append('# {}'.format(self.note))
         return '{} ({}) | {}'.format(self.net.mac, self.net.ip, ' '.join(info))
 
+    def to_dict(self):
+        """
+        Convert device information to dictionary with primitive values which can be serialized to JSON
+        """
+        data = dict(vars(self))
+        data['family'] = type(self).__name__
+        data['net'] = self.net.to_dict()
+        data['pools'] = [pool.to_dict() for pool in self.pools or []]
+        return data
+
+    @staticmethod
+    def from_dict(data):
+        """
+        Create device information from dictionary returned by `to_dict`
+
+        :param data:
+            Dictionary with device information.
+        :return:
+            Instance of device information class stored in the family item.
+        """
+        data = dict(data)
+        info_cls = DEVICE_INFO_CLASSES[data.pop('family')]
+        # skip constructor because the required arguments differ between device classes
+        device_info = info_cls.__new__(info_cls)
+        vars(device_info).update(data)
+        device_info.net = NetworkInfo.from_dict(data['net'])
+        device_info.pools = [PoolInfo.from_dict(pool) for pool in data['pools']]
+        return device_info
+
 
 class OpenWrtNetInfo(NetworkInfo):
     async def refresh(self, conn):
@@ -274,19 +386,6 @@ class AmInfo(DeviceInfo):
         return await asyncssh_run(conn, "cat /config/bmminer.conf")
 
 
-async def detect_ssh(hostname):
-    try:
-        _, writer = await asyncio.wait_for(asyncio.open_connection(hostname, 22),
-                                           timeout=0.5)
-    except OSError:
-        return False
-    except asyncio.futures.TimeoutError:
-        return False
-
-    writer.close()
-    return True
-
-
 class DmInfo(DeviceInfo):
     def __init__(self, board_name):
         super().__init__()
@@ -319,21 +418,218 @@ class DmInfo(DeviceInfo):
         return await asyncssh_run(conn, 'cat /config/note') or None
 
 
-@async_context_manager
-def asyncssh_connect(host, port, passwords):
-    last_error = None
-    for password in itertools.chain(passwords.get(host, []), passwords.get(ALL_HOSTS, [])):
+DEVICE_INFO_CLASSES = collections.OrderedDict((info_cls.__name__, info_cls) for info_cls in [BosInfo, AmInfo, DmInfo])
+
+
+class Inventory:
+    """
+    Persistent SQLite database of discovered devices keyed by MAC address
+
+    Each device is stored with a fingerprint of its configuration so unchanged devices need not be interrogated again
+    during incremental scan.
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS devices (
+            mac TEXT PRIMARY KEY,
+            host TEXT NOT NULL,
+            ip TEXT,
+            os TEXT,
+            version TEXT,
+            mode TEXT,
+            fingerprint TEXT,
+            last_seen REAL NOT NULL,
+            info TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS devices_host ON devices (host);
+    """
+    # number of changed devices after which they are committed so interrupted scan keeps its results
+    COMMIT_INTERVAL = 50
+
+    def __init__(self, path):
+        self._db = sqlite3.connect(path)
+        self._db.executescript(self.SCHEMA)
+        self._pending = 0
+
+    def _changed(self):
+        self._pending += 1
+        if self._pending >= self.COMMIT_INTERVAL:
+            self._db.commit()
+            self._pending = 0
+
+    def close(self):
+        self._db.commit()
+        self._db.close()
+
+    @staticmethod
+    def get_fingerprint(output, host_key=None):
+        """
+        Split output of fingerprint command to MAC address and fingerprint of the device
+
+        :param output:
+            Output of `FINGERPRINT_COMMAND`.
+        :param host_key:
+            Optional public host key of SSH server which is also part of the fingerprint.
+        :return:
+            Pair of MAC address and fingerprint.
+        """
+        mac, _, state = output.partition('\n')
+        digest = hashlib.sha1(state.encode())
+        if host_key:
+            digest.update(host_key)
+        return mac.strip(), digest.hexdigest()
+
+    def get(self, mac, host, fingerprint):
+        """
+        Get stored device information when the device has not been changed
+
+        :return:
+            Device information or None when device is not stored or its fingerprint or host differs.
+        """
+        row = self._db.execute('SELECT info FROM devices WHERE mac = ? AND host = ? AND fingerprint = ?',
+                               (mac, host, fingerprint)).fetchone()
+        return DeviceInfo.from_dict(json.loads(row[0])) if row else None
+
+    def touch(self, mac):
+        self._db.execute('UPDATE devices SET last_seen = ? WHERE mac = ?', (time.time(), mac))
+        self._changed()
+
+    def update(self, host, device_info, fingerprint):
+        self._db.execute('INSERT OR REPLACE INTO devices VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', (
+            device_info.net.mac, host, device_info.net.ip, device_info.os, device_info.version, device_info.mode,
+            fingerprint, time.time(), json.dumps(device_info.to_dict())
+        ))
+        self._changed()
+
+
+class CredentialCache:
+    """
+    Persistent cache of passwords which were successful for particular hosts
+
+    Besides exact host hits it counts successful passwords per /24 subnet and per device family so the most likely
+    password is tried first even for hosts which have not been seen yet.
+    """
+    SUBNET_PREFIX = 24
+
+    def __init__(self, path=None):
+        self._path = path
+        self._hosts = {}
+        self._subnets = {}
+        self._families = {}
+
+    @staticmethod
+    def load(path):
+        cache = CredentialCache(path)
         try:
-            conn, _ = yield from create_connection(None, host, port, username='root', password=password,
-                                                   known_hosts=None)
-            break
-        except asyncssh.misc.DisconnectError as e:
-            if e.code == asyncssh.DISC_NO_MORE_AUTH_METHODS_AVAILABLE:
-                last_error = e
-                continue
-    else:
-        raise last_error
+            with open(path, 'r') as cache_file:
+                data = json.load(cache_file)
+        except (OSError, ValueError):
+            # missing or corrupted cache is silently replaced by the new one
+            return cache
+        cache._hosts = {host: tuple(value) for host, value in data.get('hosts', {}).items()}
+        for name in ['subnets', 'families']:
+            counters = getattr(cache, '_' + name)
+            for key, pairs in data.get(name, {}).items():
+                counters[key] = {password: count for password, count in pairs}
+        return cache
+
+    def save(self):
+        if not self._path:
+            return
+        data = {
+            'hosts': self._hosts,
+            # passwords cannot be JSON keys because of None value so the counters are stored as list of pairs
+            'subnets': {key: list(counter.items()) for key, counter in self._subnets.items()},
+            'families': {key: list(counter.items()) for key, counter in self._families.items()}
+        }
+        os.makedirs(os.path.dirname(os.path.abspath(self._path)), exist_ok=True)
+        # cache contains passwords so it must be readable only by owner
+        fd = os.open(self._path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as cache_file:
+            json.dump(data, cache_file)
+
+    def _get_subnet(self, host):
+        try:
+            return str(ipaddress.ip_network('{}/{}'.format(host, self.SUBNET_PREFIX), strict=False))
+        except ValueError:
+            return None
+
+    def _get_family_count(self, host, password):
+        password_family = self._hosts.get(host, (None, None))[1]
+        if password_family:
+            return self._families.get(password_family, {}).get(password, 0)
+        # family of unknown host is not known so use counts of all families
+        return sum(counter.get(password, 0) for counter in self._families.values())
+
+    def sort(self, host, passwords):
+        """
+        Sort passwords from the most likely one
+
+        :param host:
+            Host name or IP address of remote host.
+        :param passwords:
+            Iterable of passwords.
+        :return:
+            List of unique passwords in order of priority.
+        """
+        host_password = self._hosts.get(host, (None, None))[0]
+        subnet_counter = self._subnets.get(self._get_subnet(host), {})
+        passwords = list(collections.OrderedDict.fromkeys(passwords))
+        # sorting is stable so passwords with the same priority keep original order
+        return sorted(passwords, key=lambda password: (
+            host in self._hosts and password == host_password,
+            subnet_counter.get(password, 0),
+            self._get_family_count(host, password)
+        ), reverse=True)
+
+    def is_cached(self, host, password):
+        """
+        Check if the password was successful for remote host last time
+        """
+        return host in self._hosts and self._hosts[host][0] == password
+
+    def add_hit(self, host, password):
+        """
+        Remember successful password for remote host
+        """
+        old_password, family = self._hosts.get(host, (None, None))
+        if host in self._hosts and old_password == password:
+            return
+        self._hosts[host] = (password, family)
+        subnet = self._get_subnet(host)
+        if subnet:
+            counter = self._subnets.setdefault(subnet, {})
+            counter[password] = counter.get(password, 0) + 1
+
+    def add_family(self, host, family):
+        """
+        Remember device family of remote host with already known password
+        """
+        if host not in self._hosts:
+            return
+        password, old_family = self._hosts[host]
+        if old_family == family:
+            return
+        self._hosts[host] = (password, family)
+        counter = self._families.setdefault(family, {})
+        counter[password] = counter.get(password, 0) + 1
+
 
+@async_context_manager
+def asyncssh_connect(host, port, passwords, credentials=None, parallel=1):
+    passwords = itertools.chain(passwords.get(host, []), passwords.get(ALL_HOSTS, []))
+    if credentials:
+        passwords = credentials.sort(host, passwords)
+        if passwords and credentials.is_cached(host, passwords[0]):
+            # cached password is tried alone and the others are raced only when it has been changed
+            try:
+                conn = yield from asyncio.ensure_future(try_password(host, port, 'root', passwords[0]))
+            except asyncssh.misc.DisconnectError:
+                passwords = passwords[1:]
+            else:
+                return conn
+    conn, password = yield from asyncio.ensure_future(race_passwords(host, port, 'root', passwords, parallel))
+    if credentials:
+        credentials.add_hit(host, password)
     return conn
 
 
@@ -342,34 +638,360 @@ async def asyncssh_run(conn, *args, cat=True):
     return result.stdout.strip() if cat else result
 
 
-async def detect_device(args, hostname):
-    if not await detect_ssh(hostname):
-        return
+class BatchConnection:
+    """
+    Connection which runs all detection commands at once in one composite shell script
 
-    try:
-        async with asyncssh_connect(hostname, 22, args.passwords) as conn:
-            for info_cls in [BosInfo, AmInfo, DmInfo]:
-                device_info = await info_cls.create(conn)
-                if device_info:
-                    # print information about detected device
-                    print(device_info.get_short())
-                    break
-    except asyncssh.misc.DisconnectError:
-        return
-    except asyncio.futures.TimeoutError:
-        return
-    except asyncssh.process.ProcessError:
-        return
+    Results of commands are cached and returned to info classes without another round-trip.
+    Commands which are not part of the batch are passed to the original connection.
+    """
+    Result = collections.namedtuple('Result', ['stdout', 'exit_status'])
+
+    def __init__(self, conn, commands):
+        self._conn = conn
+        self._commands = commands
+        self._results = {}
+
+    @staticmethod
+    async def create(conn, commands=None):
+        return await BatchConnection(conn, commands or BATCH_COMMANDS).refresh()
+
+    def get_script(self) -> str:
+        script = []
+        for index, (command, guard) in enumerate(self._commands):
+            script.append('if {}; then echo \'{} {}\'; {{ {}; }} 2>/dev/null; s=$?; echo; echo "{} {} $s"; fi'
+                          .format(guard or 'true', BATCH_MARKER, index, command, BATCH_MARKER, index))
+        return '\n'.join(script)
+
+    def parse(self, output):
+        lines = None
+        for line in output.splitlines():
+            if line.startswith(BATCH_MARKER):
+                fields = line.split()
+                if len(fields) == 2:
+                    lines = []
+                elif lines is not None:
+                    command, _ = self._commands[int(fields[1])]
+                    self._results[command] = self.Result('\n'.join(lines), int(fields[2]))
+                    lines = None
+            elif lines is not None:
+                lines.append(line)
+
+    async def refresh(self):
+        result = await asyncio.wait_for(self._conn.run(self.get_script()), timeout=BATCH_TIMEOUT)
+        self.parse(result.stdout)
+        return self
 
+    async def run(self, command):
+        result = self._results.get(command)
+        if result is None:
+            # command is not part of batch script or it has been skipped
+            return await self._conn.run(command)
+        return result
+
+
+class TableWriter:
+    """
+    Human readable output with one short line per device
+    """
+    def __init__(self, stream):
+        self._stream = stream
+
+    def write(self, device_info):
+        print(device_info.get_short(), file=self._stream, flush=True)
+
+
+class JsonLinesWriter(TableWriter):
+    """
+    JSON Lines output with all attributes of a device on one line
+    """
+    def write(self, device_info):
+        print(json.dumps(device_info.to_dict(), sort_keys=True), file=self._stream, flush=True)
+
+
+class CsvWriter(TableWriter):
+    """
+    CSV output with header and nested network information flattened to separate columns
+
+    Pools are stored in one column as JSON list because their number is not limited.
+    """
+    FIELDS = [
+        'family', 'board_name', 'os', 'version', 'mode', 'ram_size', 'note',
+        'net.mac', 'net.ip', 'net.proto', 'net.hostname',
+        'fs_version', 'miner_type', 'logic_version', 'hw_revision',
+        'pools'
+    ]
+
+    def __init__(self, stream):
+        super().__init__(stream)
+        self._writer = csv.DictWriter(stream, self.FIELDS, extrasaction='ignore')
+        self._writer.writeheader()
+
+    def write(self, device_info):
+        row = device_info.to_dict()
+        for key, value in row.pop('net').items():
+            row['net.' + key] = value
+        row['pools'] = json.dumps(row['pools'])
+        self._writer.writerow(row)
+        self._stream.flush()
+
+
+OUTPUT_WRITERS = {
+    'table': TableWriter,
+    'jsonl': JsonLinesWriter,
+    'csv': CsvWriter
+}
+
+
+class PortSweeper:
+    """
+    Fast asynchronous sweep of one TCP port with raw non-blocking sockets
+
+    The connect timeout adapts to round-trip times of previous responses in the same way as TCP retransmission
+    timeout (RFC 6298). Connection refused is also a response so it is used for the estimation too.
+    """
+    RTT_ALPHA = 1 / 8
+    RTT_BETA = 1 / 4
+    MIN_TIMEOUT = 0.2
+    # errors meaning that the host does not accept connection on the port
+    UNREACHABLE_ERRNOS = (errno.ECONNRESET, errno.ETIMEDOUT, errno.EHOSTUNREACH, errno.ENETUNREACH, errno.EHOSTDOWN)
+
+    def __init__(self, port, timeout, retries=0):
+        """
+        Initialize port sweeper
+
+        :param port:
+            TCP port to be probed.
+        :param timeout:
+            Initial timeout used before any round-trip time is measured.
+        :param retries:
+            Number of retries of timed out connections for lossy links.
+        """
+        self._port = port
+        self._initial_timeout = timeout
+        self._max_timeout = 4 * timeout
+        self._retries = retries
+        self._srtt = None
+        self._rttvar = None
+
+    @property
+    def timeout(self):
+        if self._srtt is None:
+            return self._initial_timeout
+        return min(max(self._srtt + 4 * self._rttvar, self.MIN_TIMEOUT), self._max_timeout)
+
+    def _update_rtt(self, rtt):
+        if self._srtt is None:
+            self._srtt = rtt
+            self._rttvar = rtt / 2
+        else:
+            self._rttvar = (1 - self.RTT_BETA) * self._rttvar + self.RTT_BETA * abs(self._srtt - rtt)
+            self._srtt = (1 - self.RTT_ALPHA) * self._srtt + self.RTT_ALPHA * rtt
 
-async def detect_devices(args, hostnames):
-    for hostname in hostnames:
-        await detect_device(args, str(hostname))
+    async def _get_address(self, hostname):
+        try:
+            address = ipaddress.ip_address(hostname)
+        except ValueError:
+            # resolve host name only when it is not an IP address
+            loop = asyncio.get_event_loop()
+            family, _, _, _, address = (await loop.getaddrinfo(hostname, self._port, type=socket.SOCK_STREAM))[0]
+            return family, address
+        family = socket.AF_INET if address.version == 4 else socket.AF_INET6
+        return family, (hostname, self._port)
+
+    async def _connect(self, family, address, timeout):
+        """
+        Try to connect to the port
+
+        Local errors like too many open files are raised so they are not mistaken for closed port.
+
+        :return:
+            True when port is open, False when port is closed or host is unreachable and None when connection timed out.
+        """
+        loop = asyncio.get_event_loop()
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        start = time.monotonic()
+        try:
+            await asyncio.wait_for(loop.sock_connect(sock, address), timeout=timeout)
+        except asyncio.TimeoutError:
+            return None
+        except ConnectionRefusedError:
+            self._update_rtt(time.monotonic() - start)
+            return False
+        except OSError as e:
+            if e.errno not in self.UNREACHABLE_ERRNOS:
+                raise
+            return False
+        else:
+            self._update_rtt(time.monotonic() - start)
+            return True
+        finally:
+            sock.close()
+
+    async def probe(self, hostname):
+        """
+        Check if remote host has open port
+
+        :param hostname:
+            IP address or host name of remote host.
+        :return:
+            True when remote host accepts connection on the port.
+        """
+        try:
+            family, address = await self._get_address(hostname)
+        except socket.gaierror:
+            # host name cannot be resolved
+            return False
+        for attempt in range(self._retries + 1):
+            # use exponential backoff for retries
+            result = await self._connect(family, address, min(self.timeout * 2 ** attempt, self._max_timeout))
+            if result is not None:
+                return result
+        return False
 
 
-async def discover(args, hostnames):
-    tasks = [detect_devices(args, hostnames) for _ in range(args.jobs)]
-    await asyncio.wait(tasks)
+class ScanStats:
+    """
+    Statistics of the network scan
+    """
+    def __init__(self, sweeper):
+        self._sweeper = sweeper
+        self.start = time.monotonic()
+        self.hosts = 0
+        self.ssh = 0
+        self.devices = 0
+        self.unchanged = 0
+        self.errors = 0
+        # unexpected errors counted by type of exception
+        self.failures = collections.Counter()
+
+    def add_failure(self, error):
+        self.errors += 1
+        if isinstance(error, OSError) and error.errno in errno.errorcode:
+            # local errors of the same type differ only in error number e.g. EMFILE or ENOBUFS
+            self.failures[errno.errorcode[error.errno]] += 1
+        else:
+            self.failures[type(error).__name__] += 1
+
+    def get_summary(self):
+        elapsed = time.monotonic() - self.start
+        summary = 'Scanned {} hosts in {:.1f}s ({:.1f} hosts/s, probe timeout {:.0f}ms): ' \
+                  '{} with SSH, {} devices detected ({} unchanged), {} errors'.format(
+                      self.hosts, elapsed, self.hosts / elapsed if elapsed else 0, self._sweeper.timeout * 1000,
+                      self.ssh, self.devices, self.unchanged, self.errors)
+        if self.failures:
+            summary += ' (unexpected: {})'.format(', '.join('{} {}'.format(count, name)
+                                                           for name, count in self.failures.most_common()))
+        return summary
+
+
+class Scanner:
+    """
+    Bounded work queue for scanning hosts in separate stages
+
+    Each stage (TCP probe, SSH authentication and information gathering) has its own concurrency limit so cheap port
+    probes can run in thousands while the number of SSH sessions is capped.
+    """
+    def __init__(self, args):
+        self._args = args
+        self._scan_jobs = args.scan_jobs
+        self._session_jobs = args.jobs
+        self._hosts = asyncio.Queue(maxsize=self._scan_jobs)
+        self._sessions = asyncio.Queue(maxsize=self._session_jobs)
+        self._auth = asyncio.Semaphore(args.auth_jobs)
+        self._sweeper = PortSweeper(args.port, args.scan_timeout, args.scan_retries)
+        self._credentials = args.credentials
+        self._inventory = args.inventory
+        self._writer = OUTPUT_WRITERS[args.format](sys.stdout)
+        self.stats = ScanStats(self._sweeper)
+
+    async def _produce(self, hostnames):
+        for hostname in hostnames:
+            await self._hosts.put(str(hostname))
+        # stop all scan workers
+        for _ in range(self._scan_jobs):
+            await self._hosts.put(None)
+
+    async def _scan_worker(self):
+        while True:
+            hostname = await self._hosts.get()
+            try:
+                if hostname is None:
+                    break
+                self.stats.hosts += 1
+                try:
+                    ssh = await self._sweeper.probe(hostname)
+                except Exception as e:
+                    # worker must survive any error otherwise the bounded queues are never drained
+                    self.stats.add_failure(e)
+                    continue
+                if ssh:
+                    # only hosts with SSH server continue to the next stage
+                    self.stats.ssh += 1
+                    await self._sessions.put(hostname)
+            finally:
+                self._hosts.task_done()
+
+    async def _session_worker(self):
+        while True:
+            hostname = await self._sessions.get()
+            try:
+                if hostname is None:
+                    break
+                if await self._detect_device(hostname):
+                    self.stats.devices += 1
+            except (asyncssh.Error, asyncio.TimeoutError, OSError, ValueError, LookupError):
+                # unreachable host, wrong password or unexpected output of detection commands
+                self.stats.errors += 1
+            except Exception as e:
+                # worker must survive any error otherwise the bounded queues are never drained
+                self.stats.add_failure(e)
+            finally:
+                self._sessions.task_done()
+
+    async def _get_fingerprint(self, conn, info_conn):
+        host_key = conn.get_server_host_key()
+        return Inventory.get_fingerprint(await asyncssh_run(info_conn, FINGERPRINT_COMMAND),
+                                         host_key and host_key.export_public_key())
+
+    async def _detect_device(self, hostname):
+        async with self._auth:
+            conn = await asyncssh_connect(hostname, self._args.port, self._args.passwords,
+                                          self._credentials, self._args.auth_parallel)
+        try:
+            if self._inventory and self._args.incremental:
+                # skip interrogation of devices which have not been changed since the last scan
+                mac, fingerprint = await self._get_fingerprint(conn, conn)
+                device_info = self._inventory.get(mac, hostname, fingerprint)
+                if device_info:
+                    self._inventory.touch(mac)
+                    self.stats.unchanged += 1
+                    self._writer.write(device_info)
+                    return device_info
+            # get all information in one round-trip
+            info_conn = await BatchConnection.create(conn) if self._args.batch else conn
+            for info_cls in DEVICE_INFO_CLASSES.values():
+                device_info = await info_cls.create(info_conn)
+                if device_info:
+                    if self._credentials:
+                        self._credentials.add_family(hostname, info_cls.__name__)
+                    if self._inventory:
+                        _, fingerprint = await self._get_fingerprint(conn, info_conn)
+                        self._inventory.update(hostname, device_info, fingerprint)
+                    # stream information about detected device immediately
+                    self._writer.write(device_info)
+                    return device_info
+        finally:
+            conn.close()
+
+    async def run(self, hostnames):
+        session_workers = asyncio.gather(*(self._session_worker() for _ in range(self._session_jobs)))
+        await asyncio.gather(self._produce(hostnames), *(self._scan_worker() for _ in range(self._scan_jobs)))
+        # stop all session workers after the last host has been scanned
+        for _ in range(self._session_jobs):
+            await self._sessions.put(None)
+        await session_workers
 
 
 def get_hostnames(hostname_list):
@@ -403,13 +1025,38 @@ def get_passwords(passwords_path):
     return passwords
 
 
+def set_open_files_limit(count):
+    """
+    Raise soft limit of open files to be able to run all scan jobs at once
+    """
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != resource.RLIM_INFINITY and soft < count:
+        count = count if hard == resource.RLIM_INFINITY else min(count, hard)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (count, hard))
+
+
 def main(args):
     hostnames = get_hostnames(args.hostname)
     args.passwords = get_passwords(args.passwords)
+    args.credentials = CredentialCache.load(args.credentials_cache) if args.credentials_cache else None
+    args.inventory = Inventory(args.inventory) if args.inventory else None
 
+    # reserve descriptors for all concurrent connections
+    set_open_files_limit(args.scan_jobs + args.jobs + 64)
+
+    scanner = Scanner(args)
     loop = asyncio.get_event_loop()
-    loop.run_until_complete(discover(args, hostnames))
-    loop.close()
+    try:
+        loop.run_until_complete(scanner.run(hostnames))
+    finally:
+        # keep results of interrupted scan
+        loop.close()
+        if args.credentials:
+            args.credentials.save()
+        if args.inventory:
+            args.inventory.close()
+
+    print(scanner.stats.get_summary(), file=sys.stderr)
 
 
 if __name__ == "__main__":
@@ -420,9 +1067,36 @@ if __name__ == "__main__":
                         help='list of hostnames or subnet range')
     parser.add_argument('--passwords',
                         help='path to file with list of possible passwords for connection')
+    parser.add_argument('--format', choices=sorted(OUTPUT_WRITERS), default='table',
+                        help='output format with one record per detected device')
     parser.add_argument('-j', '--jobs', type=int, default=50,
-                        help='number of concurrent jobs to scan network')
+                        help='number of concurrent SSH sessions for gathering information about devices')
+    parser.add_argument('--scan-jobs', type=int, default=1000,
+                        help='number of concurrent probes of SSH port')
+    parser.add_argument('--scan-timeout', type=float, default=0.5,
+                        help='initial timeout in seconds of SSH port probe (it adapts to measured round-trip time)')
+    parser.add_argument('--scan-retries', type=int, default=0,
+                        help='number of retries of timed out SSH port probes for lossy links')
+    parser.add_argument('--port', type=int, default=22,
+                        help='SSH port of remote hosts')
+    parser.add_argument('--auth-jobs', type=int, default=10,
+                        help='number of concurrent SSH handshakes and authentications '
+                             '(it limits only values lower than the number of SSH sessions)')
+    parser.add_argument('--auth-parallel', type=int, default=1,
+                        help='number of passwords tried in parallel for one host when its cached password is not '
+                             'known or has been rejected')
+    parser.add_argument('--credentials-cache', default=DEFAULT_CREDENTIALS_CACHE,
+                        help='path to cache of successful passwords (empty string disables the cache)')
+    parser.add_argument('--inventory',
+                        help='path to SQLite database for storing information about discovered devices')
+    parser.add_argument('--incremental', action='store_true',
+                        help='do not interrogate devices which have not been changed since the last scan '
+                             '(requires inventory)')
+    parser.add_argument('--no-batch', dest='batch', action='store_false',
+                        help='run each detection command separately instead of one composite script')
 
     # parse command line arguments
     args = parser.parse_args(sys.argv[1:])
+    if args.incremental and not args.inventory:
+        parser.error("argument --incremental: requires --inventory")
     main(args)
@@ -17,9 +17,9 @@
 
 import logging
 import subprocess
+import re
 import shutil
 import tarfile
-import copy
 import gzip
 import git
 import io
@@ -28,21 +28,26 @@ import sys
 import glob
 import filecmp
 import tempfile
+import fcntl
+import time
 
 import miner.nand as nand
 
 from itertools import chain
 from collections import OrderedDict, namedtuple
-from contextlib import contextmanager
 from termcolor import colored
 from functools import partial
 from datetime import datetime, timezone
+from getpass import getpass
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 from doit.tools import run_once, config_changed, check_timestamp_unchanged
 from urllib.request import Request, urlopen
 
-from miner.config import ListWalker, RemoteWalker, load_config
-from miner.repo import RepoProgressPrinter
-from miner.ssh import SSHManager
+from miner.config import ListWalker, RemoteWalker, TagFormatter, load_config
+from miner.repo import RepoProgressPrinter, RepoProgressLogger
+from miner.ssh import SSHManager, DEFAULT_POOL, copy_stream
+from miner.compress import CompressCache, create_tar
+from miner.upload import UploadManager as LocalUploadManager, BlobStore
 from miner.packages import Packages
 
 
@@ -95,6 +100,10 @@ class Builder:
     CONFIG_NAME = '.config'
     BUILD_KEY_NAME = 'key-build'
     BUILD_KEY_PUB_NAME = 'key-build.pub'
+    COMPRESS_CACHE_DIR = '.compress_cache'
+    UPLOAD_STORE_DIR = '.upload_store'
+    # files in the upload store and compression cache which have not been used for this time are removed
+    CACHE_MAX_AGE = 30 * 24 * 60 * 60
 
     UENV_TXT = 'uEnv.txt'
 
@@ -150,6 +159,7 @@ class Builder:
     UPGRADE_STAGE1_SCRIPT = 'stage1.sh'
     UPGRADE_STAGE2_SCRIPT = 'stage2.sh'
     UPGRADE_STAGE2 = 'stage2.tgz'
+    UPGRADE_STAGE2_MEMORY_SIZE = 4 * 1024 * 1024
     UPGRADE_FACTORY_RESTORE_SRC = 'restore.sh'
     UPGRADE_FACTORY_RESTORE = 'restore.sh'
     UPGRADE_AM_RUNME_SRC = 'runme.sh'
@@ -173,11 +183,9 @@ class Builder:
     FEED_FIRMWARE = 'firmware'
 
     # list of supported utilities
-    LEDE_MKENVIMAGE = 'mkenvimage'
     LEDE_USIGN = 'usign'
 
     LEDE_UTILITIES = {
-        LEDE_MKENVIMAGE: os.path.join('build_dir', 'host', 'u-boot-2014.10', 'tools', 'mkenvimage'),
         LEDE_USIGN: os.path.join('staging_dir', 'host', 'bin', 'usign')
     }
 
@@ -355,7 +363,7 @@ class Builder:
         :param argv:
             Command line arguments for better help printing.
         """
-        class StrFormatter:
+        class StrFormatter(TagFormatter):
             """
             Formatter class for expanding configuration string attributes
 
@@ -376,41 +384,20 @@ class Builder:
 
                 platform = config.miner.platform
                 split_platform = builder._split_platform(platform)
-                self._format_tags = {
+                super().__init__({
                     'meta_repo': repo_url.rsplit('/', 1)[0],
                     'platform': platform,
                     'target': split_platform[0],
                     'subtarget': split_platform[1],
                     'subtarget_family': split_platform[1].split('-')[0]
-                }
+                })
                 # meta_branch cannot be used when repository is detached
                 if not repo_meta.head.is_detached:
                     repo_branch = repo_meta.active_branch.name
-                    self._format_tags['meta_branch'] = repo_branch
+                    self.add_tag('meta_branch', repo_branch)
 
-            def add_tag(self, name, value):
-                """
-                Add new format tag
-
-                :param name:
-                    Name of tag.
-                :param value:
-                    Value which will be used for tag replacement.
-                """
-                self._format_tags[name] = value
-
-            def __call__(self, value: str) -> str:
-                """
-                Create callable object used in configuration parset for tag expansion
-
-                :param value:
-                    Format string with tags specified in format {NAME}.
-                :return:
-                    String with expanded tags.
-                """
-                return value.format(**self._format_tags)
-
-        self._config = copy.deepcopy(config)
+        # builder changes are not visible in the original configuration
+        self._config = config.overlay()
         self._config.formatter = StrFormatter(self)
         self._argv = argv
         self._build_dir = os.path.join(os.path.abspath(self._config.build.dir), self._config.build.name)
@@ -419,6 +406,7 @@ class Builder:
         # set working directory to LEDE root directory
         self._working_dir = self._get_repo_path(self.LEDE)
         self._tmp_dir = os.path.join(self._working_dir, 'tmp')
+        self._compress_cache = CompressCache(os.path.join(self._build_dir, self.COMPRESS_CACHE_DIR))
         self._repos = OrderedDict()
         self._init_repos()
 
@@ -624,6 +612,22 @@ class Builder:
         if error:
             raise BuilderStop
 
+    def _get_repo_progress(self, name: str):
+        """
+        Return progress printer for `git` operations with repository
+
+        Progress bars would overwrite each other when more repositories are processed in parallel so the progress is
+        logged line by line instead.
+
+        :param name:
+            The name of repository as it has been specified in configuration file.
+        :return:
+            Progress printer compatible with `git.RemoteProgress`.
+        """
+        if self._config.remote.get('jobs', 1) > 1:
+            return RepoProgressLogger(name)
+        return RepoProgressPrinter()
+
     def _clone_repo_doit(self, remote):
         """
         Clone repository when it is missing or remote server is changed
@@ -651,10 +655,84 @@ class Builder:
                           .format(name))
             raise BuilderStop
 
+        if repo:
+            self._switch_repo_remote(repo, remote)
+            return
+
         shutil.rmtree(path, ignore_errors=True)
-        repo = git.Repo.clone_from(remote.uri, path, progress=RepoProgressPrinter())
+        repo = git.Repo.clone_from(remote.uri, path, progress=self._get_repo_progress(name),
+                                   **self._get_clone_options(remote))
         self._repos[name] = repo
 
+    def _get_clone_options(self, remote) -> dict:
+        """
+        Return options for `git clone` of remote repository
+
+        :param remote:
+            Named tuple with information about remote repository.
+        :return:
+            Dictionary with options for `git.Repo.clone_from`.
+        """
+        options = {}
+        if remote.depth:
+            # all branches are fetched so any of them can be checked out later
+            options.update(depth=remote.depth, no_single_branch=True)
+        if remote.filter:
+            options['filter'] = remote.filter
+        if remote.reference:
+            self._update_reference(remote)
+            options['reference'] = remote.reference
+        return options
+
+    def _update_reference(self, remote):
+        """
+        Create or update bare mirror of remote repository used as a reference for clones
+
+        The mirror is shared by parallel clones and other build directories so it is locked during update. Its
+        references and objects are never pruned because clones borrow the objects through alternates.
+
+        :param remote:
+            Named tuple with information about remote repository.
+        """
+        os.makedirs(os.path.dirname(remote.reference), exist_ok=True)
+        with open(remote.reference + '.lock', 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            if os.path.isdir(remote.reference):
+                logging.info("Updating reference mirror '{}'...".format(remote.reference))
+                mirror = git.Repo(remote.reference)
+                mirror.git.remote('update')
+            else:
+                logging.info("Creating reference mirror '{}'...".format(remote.reference))
+                mirror = git.Repo.clone_from(remote.uri, remote.reference,
+                                             progress=self._get_repo_progress(remote.name), mirror=True)
+            # unreachable objects can be still used by clones e.g. after forced push
+            mirror.git.config('gc.pruneExpire', 'never')
+
+    def _switch_repo_remote(self, repo, remote):
+        """
+        Change URI of existing repository and fetch it from the new server
+
+        Objects which have been already fetched are reused instead of cloning the whole repository again.
+
+        :param repo:
+            Opened GIT repository without local changes.
+        :param remote:
+            Named tuple with information about remote repository.
+        """
+        logging.info("Switching repository '{}' to '{}'...".format(remote.name, remote.uri))
+        origin = repo.remotes.origin
+        origin.set_url(remote.uri)
+        fetch_options = {'prune': True}
+        if remote.depth:
+            fetch_options['depth'] = remote.depth
+        origin.fetch(progress=self._get_repo_progress(remote.name), **fetch_options)
+
+        # local branches track the old server so they are created again from the new one during checkout
+        if not repo.head.is_detached:
+            repo.git.checkout('--detach')
+        if repo.heads:
+            repo.delete_head(*repo.heads, force=True)
+
     def clone_repos_doit(self):
         """
         Clone all repositories
@@ -710,13 +788,32 @@ class Builder:
 
             # try to checkout head from local repository when fetch is disabled
 
+        def fetch_commit():
+            """
+            Fetch requested commit which is not reachable from branches fetched to shallow repository
+
+            :return:
+                True when checkout was successful after the fetch
+            """
+            if not os.path.exists(os.path.join(repo.git_dir, 'shallow')) or \
+                    not re.match(r'^[0-9a-f]{7,40}$', remote.branch):
+                return False
+            for repo_remote in repo.remotes:
+                try:
+                    # most servers allow to fetch any reachable commit directly
+                    repo.git.fetch(repo_remote.name, remote.branch, depth=remote.depth or 1)
+                except git.GitCommandError:
+                    logging.debug("Cannot fetch commit '{}', fetching whole history...".format(remote.branch))
+                    repo.git.fetch(repo_remote.name, unshallow=True)
+            return head_checkout()
+
         if remote.fetch or not head_checkout():
             # fetch remote repository when fetch is enabled or local checkout wasn't successful
             for repo_remote in repo.remotes:
                 repo_remote.fetch()
 
             # try checkout after remote fetch (it is second attempt when fetch is disabled)
-            if not head_checkout():
+            if not head_checkout() and not fetch_commit():
                 logging.error("Cannot checkout branch '{}'".format(remote.branch))
                 raise BuilderStop
 
@@ -1041,21 +1138,34 @@ class Builder:
             logging.info("Start Linux kernel configuration...'")
             self._config_kernel()
 
-    def build(self, targets=None):
+    def get_platform_tasks(self, previous) -> list:
         """
-        Build the Miner firmware for current configuration
+        Return doit tasks which switch build directory prepared for another platform to current one
 
-        It is possible alter build system by following attributes in configuration file:
+        Feeds, host tools and toolchain are shared by all platforms built in the same build directory so only
+        repositories which differ between the platforms are switched and LEDE configuration is generated again.
 
-        - `build.jobs` - number of jobs to run simultaneously (default is `1`)
-        - `build.debug` - show all commands during build process (default is `no`)
+        :param previous:
+            Builder of the platform which has been built in the same build directory.
+        :return:
+            List of doit task names which can be run without their dependencies.
+        """
+        previous_config = previous.configuration
+        previous_remotes = set(RemoteWalker(previous_config.remote, previous_config.miner.platform))
+        tasks = []
+        for remote in RemoteWalker(self._config.remote, self._config.miner.platform):
+            if remote not in previous_remotes:
+                tasks.extend(('clone:{}'.format(remote.name), 'checkout:{}'.format(remote.name)))
+        tasks.append('prepare:config')
+        return tasks
 
-        :param targets:
-            List of targets for build. Target is specified as an alias to real LEDE target.
-            The aliases are stored in configuration file under `build.aliases`
+    def _make(self, targets):
         """
-        logging.info("Start building LEDE...'")
+        Run LEDE make with options from configuration
 
+        :param targets:
+            List of LEDE make targets or empty list for building the whole LEDE.
+        """
         # set PATH environment variable
         env_path = self._config.build.get('env_path', None)
         path = env_path and [os.path.abspath(os.path.expanduser(env_path))]
@@ -1064,13 +1174,36 @@ class Builder:
         args = ['make', '-j{}'.format(self._config.build.jobs)]
         if self._config.build.verbose == 'yes':
             args.append('V=s')
-        if targets:
-            aliases = self._config.build.aliases
-            args.extend('{}/install'.format(aliases[target]) for target in targets)
-        # run make to build whole LEDE
+        args.extend(targets)
         # set umask to 0022 to fix issue with incorrect root fs access rights
         self._run(args, path=path, init=partial(os.umask, 0o0022))
 
+    def build_tools(self):
+        """
+        Build host tools and toolchain which are shared by all platforms of the same target
+        """
+        logging.info("Start building LEDE host tools and toolchain...'")
+        self._make(['tools/install', 'toolchain/install'])
+
+    def build(self, targets=None):
+        """
+        Build the Miner firmware for current configuration
+
+        It is possible alter build system by following attributes in configuration file:
+
+        - `build.jobs` - number of jobs to run simultaneously (default is `1`)
+        - `build.debug` - show all commands during build process (default is `no`)
+
+        :param targets:
+            List of targets for build. Target is specified as an alias to real LEDE target.
+            The aliases are stored in configuration file under `build.aliases`
+        """
+        logging.info("Start building LEDE...'")
+
+        aliases = self._config.build.aliases
+        # run make to build whole LEDE
+        self._make(['{}/install'.format(aliases[target]) for target in targets or []])
+
     def _write_uenv(self, stream, recovery: bool=False):
         """
         Generate content of uEnv.txt to the file stream
@@ -1108,6 +1241,8 @@ class Builder:
             Compress data with gzip before write to NAND.
         :param erase:
             Write first erasing the blocks.
+        :return:
+            Statistics of the transfer.
         """
         command = ['mtd']
         if not erase:
@@ -1115,11 +1250,13 @@ class Builder:
         if offset:
             command.extend(('-p', str(offset)))
         command.extend(('write', '-', device))
-        with open(image_path, "rb") as image_file, ssh.pipe(command) as remote:
-            if compress:
-                remote.stdin.write(gzip.compress(image_file.read()))
-            else:
-                shutil.copyfileobj(image_file, remote.stdin)
+        if compress:
+            # compressed image is reused from the cache or compressed in parallel with the transfer
+            image_file = self._compress_cache.open(image_path)
+        else:
+            image_file = open(image_path, "rb")
+        with image_file, ssh.pipe(command) as remote:
+            return copy_stream(image_file, remote.stdin)
 
     def _get_bitstream_mtd_name(self, index) -> str:
         """
@@ -1158,22 +1295,55 @@ class Builder:
         """
         return '/dev/mtd' + {1: '7', 2: '8'}.get(index)
 
-    def _write_nand_uboot(self, ssh, image):
+    def _write_nand_uboot(self, ssh, image, bitstream_mtds=()):
         """
         Write SPL and U-Boot to NAND over SSH connection
 
+        All partitions are independent so they are written over concurrent channels.
+
         :param ssh:
             Connected SSH client.
         :param image:
             Paths to firmware images.
+        :param bitstream_mtds:
+            Names of NAND partitions for FPGA bitstream which are written together with U-Boot.
+        :return:
+            Number of bytes sent to the remote miner.
         """
-        boot_images = (
-            (image.boot, 'boot'),
-            (image.uboot, 'uboot')
-        )
-        for local, mtd in boot_images:
+        boot_images = [
+            (image.boot, 'boot', False),
+            (image.uboot, 'uboot', False)
+        ]
+        boot_images.extend((image.fpga, mtd, True) for mtd in bitstream_mtds)
+
+        def write(local, mtd, compress):
             logging.info("Writing '{}' to NAND partition '{}'...".format(os.path.basename(local), mtd))
-            self._mtd_write(ssh, local, mtd)
+            stats = self._mtd_write(ssh, local, mtd, compress=compress)
+            logging.info("Written '{}' to NAND partition '{}': {}".format(os.path.basename(local), mtd, stats))
+            return stats.size
+
+        return sum(self._run_parallel(partial(write, local, mtd, compress) for local, mtd, compress in boot_images))
+
+    @staticmethod
+    def _ubi_attach(ssh, mtd: str) -> int:
+        """
+        Attach MTD device to the first free UBI device
+
+        :param ssh:
+            Connected SSH client.
+        :param mtd:
+            Path to MTD device.
+        :return:
+            Number of attached UBI device.
+        """
+        stdout, _ = ssh.run('ubiattach', '-p', mtd)
+        output = stdout.read().decode(errors='replace')
+        match = re.search(r'UBI device number (\d+)', output)
+        if not match:
+            ssh.run('ubidetach', '-p', mtd)
+            logging.error("Cannot find UBI device number for '{}' in output of ubiattach: {}".format(mtd, output))
+            raise BuilderStop
+        return int(match.group(1))
 
     def _upload_images(self, upload_manager, image, recovery: bool=False, compressed=()):
         """
@@ -1203,34 +1373,39 @@ class Builder:
                 remote += '.gz'
             upload_manager.put(local, remote, compress)
 
-    def _deploy_ssh_sd(self, ssh, sftp, image, recovery: bool):
+    def _deploy_ssh_sd(self, ssh, image, recovery: bool):
         """
         Deploy image to the SD card over SSH connection
 
         :param ssh:
             Connected SSH client.
-        :param sftp:
-            Opened SFTP connection by SSH client.
         :param image:
             Paths to firmware images.
         :param recovery:
             Transfer recovery images.
+        :return:
+            Number of bytes sent to the remote miner.
         """
         class UploadManager:
-            def __init__(self, sftp):
-                self.sftp = sftp
+            def __init__(self, ssh, remote_dir):
+                self.ssh = ssh
+                self.remote_dir = remote_dir
+                self.sent = 0
 
             def put(self, src, dst, compress=False, cache=None):
                 logging.info("Uploading '{}'...".format(dst))
-                self.sftp.put(src, dst)
+                stats = self.ssh.put(src, '{}/{}'.format(self.remote_dir, dst))
+                logging.info("Uploaded {}".format(stats))
+                self.sent += stats.size
 
         ssh.run('mount', '/dev/mmcblk0p1', '/mnt')
-        sftp.chdir('/mnt')
 
         # start uploading
-        self._upload_images(UploadManager(sftp), image, recovery)
+        upload_manager = UploadManager(ssh, '/mnt')
+        self._upload_images(upload_manager, image, recovery)
 
         ssh.run('umount', '/mnt')
+        return upload_manager.sent
 
     def _deploy_ssh_nand_recovery(self, ssh, image):
         """
@@ -1242,10 +1417,12 @@ class Builder:
             Connected SSH client.
         :param image:
             Paths to firmware images.
+        :return:
+            Number of bytes sent to the remote miner.
         """
         mtd_name = 'recovery'
 
-        self._write_nand_uboot(ssh, image)
+        sent = self._write_nand_uboot(ssh, image)
 
         # erase device before formating
         ssh.run('mtd', 'erase', mtd_name)
@@ -1253,22 +1430,23 @@ class Builder:
         local = image.kernel
         logging.info("Writing '{}' to NAND partition '{}'..."
                      .format(os.path.basename(local), mtd_name))
-        self._mtd_write(ssh, local, mtd_name)
+        sent += self._mtd_write(ssh, local, mtd_name).size
 
         local = image.factory
         logging.info("Writing '{}' to NAND partition '{}'..."
                      .format(os.path.basename(local), mtd_name))
-        self._mtd_write(ssh, local, mtd_name, offset=0x800000, compress=True, erase=False)
+        sent += self._mtd_write(ssh, local, mtd_name, offset=0x800000, compress=True, erase=False).size
 
         local = image.fpga
         logging.info("Writing '{}' to NAND partition '{}'..."
                      .format(os.path.basename(local), mtd_name))
-        self._mtd_write(ssh, local, mtd_name, offset=0x1400000, compress=True, erase=False)
+        sent += self._mtd_write(ssh, local, mtd_name, offset=0x1400000, compress=True, erase=False).size
 
         local = image.boot
         logging.info("Writing '{}' to NAND partition '{}'..."
                      .format(os.path.basename(local), mtd_name))
-        self._mtd_write(ssh, local, mtd_name, offset=0x1500000, compress=True, erase=False)
+        sent += self._mtd_write(ssh, local, mtd_name, offset=0x1500000, compress=True, erase=False).size
+        return sent
 
     def _deploy_ssh_nand(self, ssh, image):
         """
@@ -1280,27 +1458,24 @@ class Builder:
             Connected SSH client.
         :param image:
             Paths to firmware images.
+        :return:
+            Number of bytes sent to the remote miner.
         """
-        platform = self._config.miner.platform
-
-        self._write_nand_uboot(ssh, image)
-
         firmwares = (
             ('nand_firmware1', 1),
             ('nand_firmware2', 2)
         )
         targets = self._config.deploy.targets
 
+        bitstream_mtds = ()
         if self._config.deploy.write_bitstream == 'yes':
-            mtds = (self._get_bitstream_mtd_name(i) for name, i in firmwares if name in targets)
-            for mtd_name in mtds:
-                logging.info("Writing bitstream for platform '{}' to NAND partition '{}'..."
-                             .format(platform, mtd_name))
-                self._mtd_write(ssh, image.fpga, mtd_name, compress=True)
-
-        mtds = ((name[5:], self._get_firmware_mtd(i)) for name, i in firmwares if name in targets)
-        for firmware, mtd in mtds:
-            if self._config.deploy.factory_image == 'yes':
+            logging.info("Writing bitstream for platform '{}'...".format(self._config.miner.platform))
+            bitstream_mtds = [self._get_bitstream_mtd_name(i) for name, i in firmwares if name in targets]
+        sent = self._write_nand_uboot(ssh, image, bitstream_mtds)
+
+        mtds = [(name[5:], i, self._get_firmware_mtd(i)) for name, i in firmwares if name in targets]
+        if self._config.deploy.factory_image == 'yes':
+            def format_firmware(firmware, mtd):
                 logging.info("Formating '{}' ({}) with 'factory.bin'...".format(firmware, mtd))
                 # erase device before formating
                 ssh.run('mtd', 'erase', mtd)
@@ -1308,23 +1483,82 @@ class Builder:
                 image_size = os.path.getsize(image.factory)
                 with open(image.factory, "rb") as image_file:
                     with ssh.pipe('ubiformat', mtd, '-f', '-', '-S', str(image_size)) as remote:
-                        shutil.copyfileobj(image_file, remote.stdin)
-            else:
+                        stats = copy_stream(image_file, remote.stdin)
+                logging.info("Formated '{}' ({}): {}".format(firmware, mtd, stats))
+                return stats.size
+
+            # all firmware partitions are formatted concurrently
+            return sent + sum(self._run_parallel(partial(format_firmware, firmware, mtd) for firmware, _, mtd in mtds))
+
+        volume_images = (
+            ('kernel', 'sysupgrade-miner-nand/kernel', 0),
+            ('rootfs', 'sysupgrade-miner-nand/root', 1)
+        )
+        # find all volumes in the tarball only once
+        members = self._get_tar_members(image.sysupgrade, (volume_image for _, volume_image, _ in volume_images))
+
+        def update_volume(firmware, volume_name, volume_image, device):
+            offset, size = members[volume_image]
+            logging.info("Updating '{}' volume '{}' ({}) with '{}'...".format(firmware, volume_name, device,
+                                                                             volume_image))
+            with open(image.sysupgrade, 'rb') as sysupgrade_file:
+                sysupgrade_file.seek(offset)
+                with ssh.pipe('ubiupdatevol', device, '-', '-s', str(size)) as remote:
+                    stats = copy_stream(sysupgrade_file, remote.stdin, size=size)
+            logging.info("Updated '{}' volume '{}' ({}): {}".format(firmware, volume_name, device, stats))
+            return stats.size
+
+        attached = []
+        try:
+            for firmware, _, mtd in mtds:
                 logging.info("Updating '{}' ({}) volumes with 'sysupgrade.tar'...".format(firmware, mtd))
                 # use sysupgrade image which preserves overlay data from UBIFS
-                ssh.run('ubiattach', '-p', mtd)
-                volume_images = (
-                    ('kernel', 'sysupgrade-miner-nand/kernel', '/dev/ubi0_0'),
-                    ('rootfs', 'sysupgrade-miner-nand/root', '/dev/ubi0_1')
-                )
-                for volume_name, volume_image, device in volume_images:
-                    logging.info("Updating volume '{}' ({}) with '{}'...".format(volume_name, device, volume_image))
-                    with tarfile.open(image.sysupgrade, 'r') as sysupgrade_file:
-                        image_info = sysupgrade_file.getmember(volume_image)
-                        image_file = sysupgrade_file.extractfile(image_info)
-                        with ssh.pipe('ubiupdatevol', device, '-', '-s', str(image_info.size)) as remote:
-                            shutil.copyfileobj(image_file, remote.stdin)
+                # each firmware has its own UBI device so they can be updated at once
+                attached.append((firmware, mtd, self._ubi_attach(ssh, mtd)))
+            # all volumes of all firmware partitions are updated over concurrent channels
+            sent += sum(self._run_parallel(partial(update_volume, firmware, volume_name, volume_image,
+                                                   '/dev/ubi{}_{}'.format(ubi, volume_id))
+                                           for firmware, _, ubi in attached
+                                           for volume_name, volume_image, volume_id in volume_images))
+        finally:
+            for _, mtd, _ in attached:
                 ssh.run('ubidetach', '-p', mtd)
+        return sent
+
+    @staticmethod
+    def _get_tar_members(tar_path: str, names):
+        """
+        Return position of selected files in uncompressed tarball
+
+        :param tar_path:
+            Path to uncompressed tarball.
+        :param names:
+            Names of members in the tarball.
+        :return:
+            Dictionary with pair of data offset and size for each member.
+        """
+        with tarfile.open(tar_path, 'r:') as tar:
+            return {name: (member.offset_data, member.size)
+                    for name, member in ((name, tar.getmember(name)) for name in names)}
+
+    @staticmethod
+    def _run_parallel(tasks):
+        """
+        Run all tasks in separate threads and wait for all of them
+
+        The first exception raised by any task is re-raised after all tasks are finished.
+
+        :param tasks:
+            Iterable of callable objects without arguments.
+        :return:
+            List of results of all tasks in the same order.
+        """
+        tasks = list(tasks)
+        if not tasks:
+            return []
+        with ThreadPoolExecutor(max_workers=len(tasks)) as executor:
+            futures = [executor.submit(task) for task in tasks]
+        return [future.result() for future in futures]
 
     def _config_ssh_sd(self, ssh, sftp, recovery: bool):
         """
@@ -1373,13 +1607,10 @@ class Builder:
         """
         # write miner configuration to miner_cfg NAND
         if self._config.deploy.write_miner_cfg == 'yes':
-            miner_cfg_input = io.BytesIO()
-            if not nand.write_miner_cfg_input(self._config, miner_cfg_input):
-                raise BuilderStop
             # generate image file with NAND configuration
-            mkenvimage = self._get_utility(self.LEDE_MKENVIMAGE)
-            output = self._run(mkenvimage, '-r', '-p', str(0), '-s', str(nand.MINER_CFG_SIZE), '-',
-                               input=miner_cfg_input.getvalue(), output=True)
+            output = nand.create_miner_cfg_image(self._config)
+            if output is None:
+                raise BuilderStop
             logging.info("Writing miner configuration to NAND partition 'miner_cfg'...")
             with ssh.pipe('mtd', 'write', '-', 'miner_cfg') as remote:
                 remote.stdin.write(output)
@@ -1387,9 +1618,9 @@ class Builder:
         # change miner configuration in U-Boot env
         if self._config.deploy.set_miner_env == 'yes' and self._config.deploy.reset_uboot_env == 'no':
             logging.info("Writing miner configuration to U-Boot env in NAND...")
-            ssh.run('fw_setenv', nand.NET_MAC, self._config.net.mac)
-            ssh.run('fw_setenv', nand.MINER_HWID, self._config.miner.hwid)
-            ssh.run('fw_setenv', nand.MINER_FIRMWARE, str(self._config.miner.firmware))
+            ssh.run_batch(['fw_setenv', nand.NET_MAC, self._config.net.mac],
+                          ['fw_setenv', nand.MINER_HWID, self._config.miner.hwid],
+                          ['fw_setenv', nand.MINER_FIRMWARE, str(self._config.miner.firmware)])
 
         reset_uboot_env = self._config.deploy.reset_uboot_env == 'yes'
         reset_overlay = self._config.deploy.reset_overlay == 'yes'
@@ -1398,7 +1629,7 @@ class Builder:
 
         if ubi_attach:
             firmware_mtd = self._get_firmware_mtd(self._config.miner.firmware)
-            ssh.run('ubiattach', '-p', firmware_mtd)
+            ubi = self._ubi_attach(ssh, firmware_mtd)
 
         if reset_uboot_env:
             logging.info("Erasing NAND partition 'uboot_env'...")
@@ -1407,12 +1638,12 @@ class Builder:
         # truncate overlay for current firmware
         if reset_overlay:
             logging.info("Truncating UBI volume 'rootfs_data'...")
-            ssh.run('ubiupdatevol', '/dev/ubi0_2', '-t')
+            ssh.run('ubiupdatevol', '/dev/ubi{}_2'.format(ubi), '-t')
 
         if ubi_attach:
             ssh.run('ubidetach', '-p', firmware_mtd)
 
-    def _deploy_ssh(self, images, sd_config: bool, nand_config: bool):
+    def _deploy_ssh(self, images, sd_config: bool, nand_config: bool, hostname: str=None, interactive: bool=True):
         """
         Deploy NAND or SD card image over SSH connection
 
@@ -1430,8 +1661,15 @@ class Builder:
             Modify configuration files on SD card.
         :param nand_config:
             Modify configuration files/partitions on NAND.
+        :param hostname:
+            Override hostname of remote miner from configuration.
+        :param interactive:
+            Prompt the user for another password when the configured one is rejected.
+        :return:
+            Number of bytes of images sent to the remote miner.
         """
-        hostname = self._config.deploy.ssh.get('hostname', None) or self._config.net.get('hostname', None)
+        hostname = hostname or \
+            self._config.deploy.ssh.get('hostname', None) or self._config.net.get('hostname', None)
         password = self._config.deploy.ssh.get('password', None)
         username = self._config.deploy.ssh.username
 
@@ -1440,7 +1678,9 @@ class Builder:
             hostname_suffix = self._config.deploy.ssh.get('hostname_suffix', '')
             hostname = self._get_hostname() + hostname_suffix
 
-        with SSHManager(hostname, username, password) as ssh:
+        sent = 0
+        with SSHManager(hostname, username, password, pool=DEFAULT_POOL,
+                        password_prompt=getpass if interactive else None) as ssh:
             sftp = ssh.open_sftp()
 
             image_sd = images.get('sd')
@@ -1450,13 +1690,13 @@ class Builder:
             sd_recovery = image_sd and isinstance(image_sd, ImageRecovery)
 
             if image_sd:
-                self._deploy_ssh_sd(ssh, sftp, image_sd, sd_recovery)
+                sent += self._deploy_ssh_sd(ssh, image_sd, sd_recovery)
             if sd_config:
                 self._config_ssh_sd(ssh, sftp, sd_recovery)
             if image_nand_recovery:
-                self._deploy_ssh_nand_recovery(ssh, image_nand_recovery)
+                sent += self._deploy_ssh_nand_recovery(ssh, image_nand_recovery)
             if image_nand:
-                self._deploy_ssh_nand(ssh, image_nand)
+                sent += self._deploy_ssh_nand(ssh, image_nand)
             if nand_config:
                 self._config_ssh_nand(ssh)
 
@@ -1465,6 +1705,64 @@ class Builder:
                 ssh.run('reboot')
 
             sftp.close()
+        return sent
+
+    def _deploy_fleet(self, hosts, parallel: int, images, sd_config: bool, nand_config: bool):
+        """
+        Deploy the same NAND or SD card image to many miners concurrently over SSH connections
+
+        :param hosts:
+            List of hostnames or IP addresses of remote miners.
+        :param parallel:
+            Maximal number of miners deployed at once.
+        :param images:
+            List of images for deployment.
+        :param sd_config:
+            Modify configuration files on SD card.
+        :param nand_config:
+            Modify configuration files/partitions on NAND.
+        """
+        # configuration unique for each miner cannot be written to more miners
+        if len(hosts) > 1:
+            deploy = self._config.deploy
+            if nand_config and 'yes' in (deploy.write_miner_cfg, deploy.set_miner_env):
+                logging.error("Options 'write_miner_cfg' and 'set_miner_env' cannot be used for more miners")
+                raise BuilderStop
+            if sd_config and self._config.uenv.get('mac', 'no') == 'yes':
+                logging.error("Option 'uenv.mac' cannot be used for more miners")
+                raise BuilderStop
+
+        logging.info("Deploying to {} miners ({} at once)...".format(len(hosts), parallel))
+        start = time.monotonic()
+        results = OrderedDict((hostname, None) for hostname in hosts)
+        sent = 0
+        with ThreadPoolExecutor(max_workers=parallel) as executor:
+            # rejected password must not prompt the user from more threads at once
+            futures = {executor.submit(self._deploy_ssh, images, sd_config, nand_config, hostname, False): hostname
+                       for hostname in hosts}
+            for future in as_completed(futures):
+                hostname = futures[future]
+                try:
+                    sent += future.result()
+                except Exception as e:
+                    # failure of one miner must not stop deployment of the others
+                    results[hostname] = str(e) or type(e).__name__
+                    logging.error("Deployment to '{}' failed: {}".format(hostname, results[hostname]))
+                else:
+                    logging.info("Deployment to '{}' finished".format(hostname))
+        elapsed = time.monotonic() - start
+
+        succeeded = 0
+        for hostname, error in results.items():
+            if error:
+                print('{}: {}'.format(hostname, colored('FAILED ({})'.format(error), 'red')))
+            else:
+                print('{}: {}'.format(hostname, colored('OK', 'green')))
+                succeeded += 1
+        print('Deployed to {} of {} miners in {:.1f}s ({:.2f} MiB/s)'.format(
+            succeeded, len(hosts), elapsed, sent / elapsed / 2**20 if elapsed else 0))
+        if succeeded != len(hosts):
+            raise BuilderStop
 
     def _get_local_target_dir(self, dir_name: str):
         """
@@ -1515,7 +1813,7 @@ class Builder:
 
     def _create_upgrade_miner_cfg_input(self):
         """
-        Create input source for mkenvimage with miner configuration
+        Create input source for environment image with miner configuration
         The configuration does not include MAC and HWID information.
 
         :return:
@@ -1533,7 +1831,6 @@ class Builder:
         :return:
             Bytes stream with U-Boot environment.
         """
-        mkenvimage = self._get_utility(self.LEDE_MKENVIMAGE)
         uboot_env_base_input = self._get_project_file(self.UPGRADE_DIR, self.UPGRADE_UBOOT_ENV_TXT)
         uboot_env_input = self._create_upgrade_miner_cfg_input()
 
@@ -1541,10 +1838,7 @@ class Builder:
         with open(uboot_env_base_input, 'rb') as base_input_file:
             shutil.copyfileobj(base_input_file, uboot_env_input)
 
-        return io.BytesIO(
-            self._run(mkenvimage, '-r', '-p', str(0), '-s', str(nand.MINER_ENV_SIZE), '-',
-                      input=uboot_env_input.getvalue(), output=True)
-        )
+        return io.BytesIO(nand.create_env_image(uboot_env_input.getvalue(), nand.MINER_ENV_SIZE))
 
     def _create_upgrade_miner_cfg(self):
         """
@@ -1553,13 +1847,9 @@ class Builder:
         :return:
             Bytes stream with miner configuration environment.
         """
-        mkenvimage = self._get_utility(self.LEDE_MKENVIMAGE)
         miner_cfg_input = self._create_upgrade_miner_cfg_input()
 
-        return io.BytesIO(
-            self._run(mkenvimage, '-r', '-p', str(0), '-s', str(nand.MINER_CFG_SIZE), '-',
-                      input=miner_cfg_input.getvalue(), output=True)
-        )
+        return io.BytesIO(nand.create_env_image(miner_cfg_input.getvalue(), nand.MINER_CFG_SIZE))
 
     def _add2tar_compressed_file(self, tar, file_path, arcname):
         """
@@ -1573,13 +1863,11 @@ class Builder:
             Name of file in the archive.
         """
         file_info = tar.gettarinfo(file_path, arcname=arcname)
+        compressed_path = self._compress_cache.get(file_path)
+        file_info.size = os.path.getsize(compressed_path)
 
-        with open(file_path, "rb") as image_file:
-            compressed_file = gzip.compress(image_file.read())
-            file_info.size = len(compressed_file)
-            compressed_file = io.BytesIO(compressed_file)
-
-        tar.addfile(file_info, compressed_file)
+        with open(compressed_path, "rb") as compressed_file:
+            tar.addfile(file_info, compressed_file)
 
     def _create_upgrade_stage2(self, image):
         """
@@ -1590,7 +1878,13 @@ class Builder:
         """
         logging.info("Creating upgrade stage2 tarball...")
 
-        stage2 = io.BytesIO()
+        # compress all large images at once in advance so they are only taken from the cache
+        compressed_images = (image.boot, image.fpga, image.factory)
+        with ThreadPoolExecutor(max_workers=len(compressed_images)) as executor:
+            list(executor.map(self._compress_cache.get, compressed_images))
+
+        # the tarball is kept in memory only when it is small
+        stage2 = tempfile.SpooledTemporaryFile(max_size=self.UPGRADE_STAGE2_MEMORY_SIZE)
         tar = tarfile.open(mode = "w:gz", fileobj=stage2)
 
         # add recovery image
@@ -1773,20 +2067,13 @@ class Builder:
         :param image:
             Paths to firmware images.
         """
-        @contextmanager
-        def get_dst_path(temporary: bool):
-            if temporary:
-                directory = tempfile.TemporaryDirectory()
-                yield directory.name
-                directory.cleanup()
-            else:
-                yield target_dir
-
-        cache = None
+        # all versions share named files like stage2 tarball
+        cache = {}
         versions = next((value for pattern, value in sorted(self.UPGRADE_VERSION.items(), reverse=True)
                          if self._config.miner.platform.startswith(pattern)), None)
+        staging_dirs = []
 
-        for version, (archive, archive_flags) in versions:
+        def stage_version(version, archive, archive_flags):
             # create subdirectory for specific version
             subtarget_path = '{}_{}_{}_{}'.format(
                 self.UPGRADE_IMAGE_PREFIX,
@@ -1794,24 +2081,49 @@ class Builder:
                 version[1],
                 self.get_firmware_version())
 
-            with get_dst_path(archive is not None) as dst_path:
-                upload_manager = upload_manager_cls(dst_path, cache=cache)
-                if self.ARCHIVE_FLAG_FLAT not in archive_flags:
-                    upload_manager.push_dir(subtarget_path)
-
-                # prepare local image for potential archiving
-                self._deploy_local_upgrade(upload_manager, image, version)
-
-                # archive result
-                if archive in [self.ARCHIVE_TGZ, self.ARCHIVE_TBZ2]:
-                    dst_file_path = os.path.join(target_dir, subtarget_path) + '.' + archive
-                    mode = "w:{}".format(archive.split('.')[1])
-                    with tarfile.open(dst_file_path, mode) as tar:
-                        for file_path in os.listdir(dst_path):
-                            tar.add(os.path.join(dst_path, file_path), arcname=file_path)
-
-            # use cache for next run to get same shared objects
-            cache = upload_manager.get_cache()
+            if archive is not None:
+                # files are staged only for archiving and they are never modified so they can be hard linked
+                staging_dir = tempfile.TemporaryDirectory(dir=self._build_dir)
+                staging_dirs.append(staging_dir)
+                dst_path = staging_dir.name
+            else:
+                dst_path = target_dir
+
+            upload_manager = upload_manager_cls(dst_path, cache=cache, hardlink=archive is not None)
+            if self.ARCHIVE_FLAG_FLAT not in archive_flags:
+                upload_manager.push_dir(subtarget_path)
+
+            # prepare local image for potential archiving
+            self._deploy_local_upgrade(upload_manager, image, version)
+
+            if archive in [self.ARCHIVE_TGZ, self.ARCHIVE_TBZ2]:
+                dst_file_path = os.path.join(target_dir, subtarget_path) + '.' + archive
+                return dst_file_path, dst_path, archive.split('.')[1]
+            return None
+
+        try:
+            with ThreadPoolExecutor(max_workers=len(versions)) as stage_executor, \
+                    ProcessPoolExecutor(max_workers=len(versions)) as tar_executor:
+                archives = []
+
+                def create_archive(args):
+                    if args:
+                        logging.info("Creating archive '{}'...".format(os.path.basename(args[0])))
+                        archives.append(tar_executor.submit(create_tar, *args))
+
+                # the first version is staged alone to fill the cache with files shared by all versions
+                (version, (archive, archive_flags)), others = versions[0], versions[1:]
+                create_archive(stage_version(version, archive, archive_flags))
+                # archiving of each version starts as soon as its files are staged
+                futures = [stage_executor.submit(stage_version, version, archive, archive_flags)
+                           for version, (archive, archive_flags) in others]
+                for future in as_completed(futures):
+                    create_archive(future.result())
+                for future in archives:
+                    future.result()
+        finally:
+            for staging_dir in staging_dirs:
+                staging_dir.cleanup()
 
     def _deploy_local(self, images, sd_config: bool, sd_recovery_config: bool):
         """
@@ -1826,46 +2138,9 @@ class Builder:
         :param sd_recovery_config:
             Generate configuration files for recovery SD card version.
         """
-        class UploadManager:
-            def __init__(self, target_dir: str, cache=None):
-                self._target_dir_prev = []
-                self._target_dir = target_dir
-                self._cache = cache or {}
-
-            def get_cache(self):
-                return self._cache
-
-            def push_dir(self, path):
-                self._target_dir_prev.append(self._target_dir)
-                self._target_dir = os.path.join(self._target_dir, path)
-                os.makedirs(self._target_dir, exist_ok=True)
-
-            def pop_dir(self):
-                self._target_dir = self._target_dir_prev.pop()
-
-            def put(self, src, dst, compress=False, cache: str=None):
-                src_path = type(src) is str
-                if cache and not src:
-                    src_file = self._cache.get(cache)
-                    if not src_file:
-                        # file is not found in cache
-                        return False
-                    src_file.seek(0)
-                else:
-                    src_file = open(src, 'rb') if src_path else src
-                    if cache and not src_path:
-                        self._cache[cache] = src_file
-                logging.info("Copying '{}' to '{}'...".format(dst, self._target_dir))
-                dst_file = open(os.path.join(self._target_dir, dst), 'wb')
-                if compress:
-                    # set gzip to get reproducible output
-                    dst_file = gzip.GzipFile(filename='', mode='wb', fileobj=dst_file, mtime=0)
-                shutil.copyfileobj(src_file, dst_file)
-                dst_file.close()
-
-                if src_path:
-                    src_file.close()
-                return True
+        # all local targets share one content-addressed store of uploaded files
+        store = BlobStore(os.path.join(self._build_dir, self.UPLOAD_STORE_DIR))
+        UploadManager = partial(LocalUploadManager, store=store, compress_cache=self._compress_cache)
 
         image_sd = images.get('sd')
         image_sd_recovery = images.get('sd_recovery')
@@ -1891,6 +2166,10 @@ class Builder:
             target_dir = self._get_local_target_dir('upgrade')
             self._deploy_local_upgrades(UploadManager, target_dir, image_upgrade)
 
+        count = store.prune(self.CACHE_MAX_AGE) + self._compress_cache.prune(self.CACHE_MAX_AGE)
+        if count:
+            logging.info("Removed {} unused files from upload store and compression cache".format(count))
+
     def _deploy_feeds(self, images):
         """
         Deploy package feeds to local file system
@@ -1971,9 +2250,14 @@ class Builder:
                     factory=os.path.join(generic_dir, 'lede-{}-nand-squashfs-factory.bin'.format(platform))
                 )
 
-    def deploy(self):
+    def deploy(self, hosts=None, parallel: int=1):
         """
         Deploy Miner firmware to target platform
+
+        :param hosts:
+            Optional list of remote miners which are deployed at once instead of the miner from configuration.
+        :param parallel:
+            Maximal number of remote miners deployed concurrently.
         """
         platform = self._config.miner.platform
         platform_target, _ = self._split_platform(platform)
@@ -2095,7 +2379,12 @@ class Builder:
         sd_config_local = 'local_sd_config' in targets
         sd_recovery_config = 'local_sd_recovery_config' in targets
 
-        if images_ssh or sd_config or nand_config:
+        if hosts and not (images_ssh or sd_config or nand_config):
+            logging.error("Option '--hosts' requires at least one remote target but only local targets are selected")
+            raise BuilderStop
+        if hosts:
+            self._deploy_fleet(hosts, parallel, images_ssh, sd_config, nand_config)
+        elif images_ssh or sd_config or nand_config:
             self._deploy_ssh(images_ssh, sd_config, nand_config)
         if images_local or sd_config_local or sd_recovery_config:
             self._deploy_local(images_local, sd_config_local, sd_recovery_config)
@@ -2378,8 +2667,8 @@ class Builder:
         logging.debug("Detaching head from branch...")
         repo_meta.head.reference = repo_meta.head.commit
 
-        # copy configuration for modifications
-        config = copy.deepcopy(config_original)
+        # overlay configuration for modifications
+        config = config_original.overlay()
 
         # always checkout all repositories to correct commit
         config.remote.fetch_always = 'yes'
@@ -0,0 +1,361 @@
+# Copyright (C) 2018  Braiins Systems s.r.o.
+#
+# This file is part of Braiins Build System (BB).
+#
+# BB is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import subprocess
+import threading
+import tempfile
+import tarfile
+import hashlib
+import shutil
+import queue
+import time
+import zlib
+import os
+
+# size of uncompressed data read from source file at once
+CHUNK_SIZE = 1024 * 1024
+# number of compressed chunks waiting for the reader
+QUEUE_SIZE = 4
+# window bits for zlib which produce gzip header and trailer
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+# parallel implementations of compression utilities in order of preference
+PARALLEL_COMPRESSORS = {
+    'gz': ('pigz',),
+    'bz2': ('lbzip2', 'pbzip2'),
+}
+
+
+class GzipReader:
+    """
+    Read-only file object returning gzip compressed content of another file object
+
+    Data are compressed by a background thread chunk by chunk so the compression overlaps with writing of already
+    compressed data. The memory usage is bounded by the chunk size and the length of the queue.
+    """
+    def __init__(self, fileobj, chunk_size: int=CHUNK_SIZE, compresslevel: int=9, closefd: bool=True):
+        """
+        Start compression of the file object
+
+        :param fileobj:
+            Source file object opened in binary mode.
+        :param chunk_size:
+            Size of uncompressed data read from source file at once.
+        :param compresslevel:
+            Compression level in the same range as for `gzip.compress`.
+        :param closefd:
+            Close source file object when the reader is closed.
+        """
+        self._queue = queue.Queue(maxsize=QUEUE_SIZE)
+        self._chunk = b''
+        self._offset = 0
+        self._eof = False
+        self._error = None
+        self._closed = False
+        self._fileobj = fileobj
+        self._closefd = closefd
+        self._thread = threading.Thread(target=self._compress, args=(fileobj, chunk_size, compresslevel),
+                                        daemon=True)
+        self._thread.start()
+
+    def _compress(self, fileobj, chunk_size, compresslevel):
+        # the gzip header has zero modification time so the output is reproducible
+        compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, GZIP_WBITS)
+        try:
+            while not self._closed:
+                data = fileobj.read(chunk_size)
+                if not data:
+                    self._queue.put(compressor.flush())
+                    break
+                compressed = compressor.compress(data)
+                if compressed:
+                    self._queue.put(compressed)
+        except Exception as e:
+            # any error is re-raised in the reading thread
+            self._error = e
+        finally:
+            self._queue.put(None)
+
+    def _next_chunk(self) -> bool:
+        """
+        Wait for next compressed chunk
+
+        :return:
+            False when all data have been read.
+        """
+        chunk = self._queue.get()
+        if chunk is None:
+            self._eof = True
+            if self._error:
+                raise self._error
+            return False
+        self._chunk = chunk
+        self._offset = 0
+        return True
+
+    def read(self, size: int=-1) -> bytes:
+        """
+        Read compressed data
+
+        :param size:
+            Maximal number of bytes returned. When it is negative then all remaining data are returned.
+        :return:
+            Compressed data which can be shorter than requested size. Empty bytes means end of file.
+        """
+        if size < 0:
+            return b''.join(iter(lambda: self.read(CHUNK_SIZE), b''))
+        while self._offset >= len(self._chunk):
+            if self._eof or not self._next_chunk():
+                return b''
+        data = self._chunk[self._offset:self._offset + size]
+        self._offset += len(data)
+        return data
+
+    def close(self):
+        """
+        Stop the background thread, release all queued data and close source file object if it is owned by the reader
+        """
+        self._closed = True
+        while not self._eof:
+            if self._queue.get() is None:
+                self._eof = True
+        self._thread.join()
+        if self._closefd:
+            self._fileobj.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class CachingReader:
+    """
+    Read-only file object which copies all read data to a new entry of the compression cache
+
+    The entry is stored only when the whole file has been read.
+    """
+    def __init__(self, reader, cache_path: str):
+        self._reader = reader
+        self._cache_path = cache_path
+        cache_dir = os.path.dirname(cache_path)
+        os.makedirs(cache_dir, exist_ok=True)
+        self._cache_file = tempfile.NamedTemporaryFile(dir=cache_dir, delete=False)
+
+    def read(self, size: int=-1) -> bytes:
+        data = self._reader.read(size)
+        if self._cache_file:
+            if data:
+                self._cache_file.write(data)
+            elif size:
+                # end of file has been reached
+                self._cache_file.close()
+                os.replace(self._cache_file.name, self._cache_path)
+                self._cache_file = None
+        return data
+
+    def close(self):
+        self._reader.close()
+        if self._cache_file:
+            # discard incomplete entry
+            self._cache_file.close()
+            os.unlink(self._cache_file.name)
+            self._cache_file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class CompressCache:
+    """
+    Content-addressed cache of reproducible gzip compressed files
+
+    Entries are keyed by SHA-256 of source file content and compression parameters so the same image is compressed
+    only once even when it is rebuilt with the same content.
+    """
+    def __init__(self, cache_dir: str, compresslevel: int=9):
+        """
+        Initialize cache in a directory
+
+        :param cache_dir:
+            Path to directory with compressed files.
+        :param compresslevel:
+            Compression level of all cached files.
+        """
+        self._cache_dir = cache_dir
+        self._compresslevel = compresslevel
+        self._digests = {}
+        self._lock = threading.Lock()
+        self._entry_locks = {}
+
+    def _get_digest(self, file_path: str) -> str:
+        """
+        Return hash of file content which is remembered until the file is modified
+        """
+        stat = os.stat(file_path)
+        key = (os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns)
+        digest = self._digests.get(key)
+        if not digest:
+            sha256 = hashlib.sha256()
+            with open(file_path, 'rb') as file:
+                for data in iter(lambda: file.read(CHUNK_SIZE), b''):
+                    sha256.update(data)
+            digest = sha256.hexdigest()
+            self._digests[key] = digest
+        return digest
+
+    def _get_path(self, file_path: str) -> str:
+        digest = self._get_digest(file_path)
+        return os.path.join(self._cache_dir, digest[:2], '{}-{}.gz'.format(digest, self._compresslevel))
+
+    def open(self, file_path: str):
+        """
+        Open compressed content of the file
+
+        When the file is not in the cache then it is compressed on the fly and stored in the cache during reading.
+
+        :param file_path:
+            Path to uncompressed file.
+        :return:
+            File object with gzip compressed data.
+        """
+        cache_path = self._get_path(file_path)
+        if os.path.isfile(cache_path):
+            touch_file(cache_path)
+            return open(cache_path, 'rb')
+        return CachingReader(GzipReader(open(file_path, 'rb'), compresslevel=self._compresslevel), cache_path)
+
+    def get(self, file_path: str) -> str:
+        """
+        Return path to compressed content of the file
+
+        :param file_path:
+            Path to uncompressed file.
+        :return:
+            Path to gzip compressed file in the cache.
+        """
+        cache_path = self._get_path(file_path)
+        with self._lock:
+            entry_lock = self._entry_locks.setdefault(cache_path, threading.Lock())
+        # different files can be compressed in parallel
+        with entry_lock:
+            if not os.path.isfile(cache_path):
+                with self.open(file_path) as compressed_file:
+                    while compressed_file.read(CHUNK_SIZE):
+                        pass
+            else:
+                touch_file(cache_path)
+        return cache_path
+
+    def prune(self, max_age: float) -> int:
+        """
+        Remove entries which have not been used for a given time
+
+        :param max_age:
+            Maximal age of unused entry in seconds.
+        :return:
+            Number of removed entries.
+        """
+        return prune_dir(self._cache_dir, max_age)
+
+
+def touch_file(file_path: str):
+    """
+    Mark the file as used
+
+    Access time is used as time of last use for pruning. Modification time is preserved because it identifies
+    the content of copies made from the file.
+    """
+    stat = os.stat(file_path)
+    os.utime(file_path, ns=(int(time.time() * 10**9), stat.st_mtime_ns))
+
+
+def prune_dir(cache_dir: str, max_age: float) -> int:
+    """
+    Remove files in cache directory which have not been used for a given time
+
+    It also removes stale temporary files left by interrupted builds.
+
+    :param cache_dir:
+        Path to cache directory.
+    :param max_age:
+        Maximal age of file in seconds.
+    :return:
+        Number of removed files.
+    """
+    count = 0
+    deadline = time.time() - max_age
+    for root, dirs, files in os.walk(cache_dir):
+        for file_name in files:
+            file_path = os.path.join(root, file_name)
+            try:
+                if os.lstat(file_path).st_atime < deadline:
+                    os.unlink(file_path)
+                    count += 1
+            except FileNotFoundError:
+                # file has been removed concurrently
+                pass
+    return count
+
+
+def _normalize_tarinfo(tarinfo):
+    """
+    Reset attributes which depend on the way the files were staged
+    """
+    tarinfo.mode = 0o755 if tarinfo.isdir() else 0o644
+    return tarinfo
+
+
+def create_tar(tar_path: str, src_dir: str, compression: str):
+    """
+    Create compressed tarball with all files from source directory
+
+    External parallel compressor is used when it is available on the system otherwise compression is done by
+    `tarfile` module. It is a module-level function so it can be run in a process pool.
+
+    :param tar_path:
+        Path to created tarball.
+    :param src_dir:
+        Directory with files which are added to the root of the tarball.
+    :param compression:
+        Compression type supported by `tarfile` module ('gz' or 'bz2').
+    """
+    compressor = next(filter(None, map(shutil.which, PARALLEL_COMPRESSORS.get(compression, ()))), None)
+
+    def add_files(tar):
+        for file_name in sorted(os.listdir(src_dir)):
+            tar.add(os.path.join(src_dir, file_name), arcname=file_name, filter=_normalize_tarinfo)
+
+    if not compressor:
+        with tarfile.open(tar_path, 'w:{}'.format(compression)) as tar:
+            add_files(tar)
+        return
+
+    with open(tar_path, 'wb') as tar_file:
+        process = subprocess.Popen([compressor, '-c'], stdin=subprocess.PIPE, stdout=tar_file)
+        try:
+            with tarfile.open(fileobj=process.stdin, mode='w|') as tar:
+                add_files(tar)
+        finally:
+            process.stdin.close()
+            returncode = process.wait()
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, compressor)
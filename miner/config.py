@@ -15,9 +15,17 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import tempfile
+import hashlib
+import marshal
 import copy
+import sys
+import os
+import re
 
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
+from collections.abc import MutableMapping
+from functools import lru_cache
 from ruamel import yaml
 from ruamel.yaml.comments import CommentedMap, CommentedSeq
 
@@ -27,9 +35,173 @@ YAML_LIST_TYPE = CommentedSeq
 EmptyDict = CommentedMap
 EmptyList = CommentedSeq
 
+# compiled configuration is stored next to the configuration file like Python byte code
+CONFIG_CACHE_DIR = '__pycache__'
+CONFIG_CACHE_VERSION = 1
+
+
+@lru_cache(maxsize=None)
+def _split_path(path: str) -> tuple:
+    """
+    Split path to the attribute only once for all configurations
+    """
+    return tuple(path.split('.'))
+
+
+class TagFormatter:
+    """
+    Formatter for expanding configuration string attributes with format tags '{NAME}'
+
+    Expanded strings are remembered until the set of tags is changed.
+    """
+    def __init__(self, format_tags=None):
+        """
+        Initialize formatter object
+
+        :param format_tags:
+            Dictionary with names and values of format tags.
+        """
+        self._format_tags = dict(format_tags or {})
+        self._formatted = {}
+
+    def add_tag(self, name, value):
+        """
+        Add new format tag
+
+        :param name:
+            Name of tag.
+        :param value:
+            Value which will be used for tag replacement.
+        """
+        self._format_tags[name] = value
+        self._formatted.clear()
+
+    def __call__(self, value: str) -> str:
+        """
+        Create callable object used in configuration parset for tag expansion
+
+        :param value:
+            Format string with tags specified in format {NAME}.
+        :return:
+            String with expanded tags.
+        """
+        formatted = self._formatted.get(value)
+        if formatted is None:
+            formatted = value.format(**self._format_tags)
+            self._formatted[value] = formatted
+        return formatted
+
+
+class ConfigLayer(MutableMapping):
+    """
+    Copy-on-write overlay of `YAML` dictionary
+
+    Lookups go through the overlay to the base dictionary which is never modified. Nested dictionaries are overlaid
+    when they are accessed for the first time so the cost of new layer is proportional to the number of changes.
+    """
+    def __init__(self, base):
+        """
+        Create empty overlay of the dictionary
+
+        :param base:
+            `YAML` dictionary or another layer.
+        """
+        self._base = base
+        self._changes = OrderedDict()
+        self._deleted = set()
+
+    def __getitem__(self, key):
+        if key in self._changes:
+            return self._changes[key]
+        if key in self._deleted:
+            raise KeyError(key)
+        value = self._base[key]
+        if type(value) in (YAML_DICT_TYPE, YAML_LIST_TYPE, ConfigLayer):
+            # nested node have to be overlaid before it is returned for modification
+            value = _overlay(value)
+            self._changes[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        self._changes[key] = value
+        self._deleted.discard(key)
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self._changes.pop(key, None)
+        if key in self._base:
+            self._deleted.add(key)
+
+    def __contains__(self, key):
+        return key in self._changes or (key not in self._deleted and key in self._base)
+
+    def __iter__(self):
+        for key in self._base:
+            if key not in self._deleted:
+                yield key
+        for key in self._changes:
+            if key not in self._base:
+                yield key
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return repr(self.flatten())
+
+    def flatten(self):
+        """
+        Merge all layers to one `YAML` dictionary
+
+        Comments and formatting of the original dictionary are preserved. Nodes without changes are shared with the
+        base dictionary.
+
+        :return:
+            `YAML` dictionary with the same content as the overlay.
+        """
+        result = YAML_DICT_TYPE()
+        base = self._base
+        while type(base) is ConfigLayer:
+            base = base._base
+        base.copy_attributes(result)
+        for key in self:
+            value = self._changes[key] if key in self._changes else self._base[key]
+            result[key] = _flatten(value)
+        return result
+
+
+def _overlay(value):
+    """
+    Return copy-on-write version of configuration node
+
+    Dictionaries are overlaid and lists are copied because they are usually replaced as a whole.
+    """
+    if type(value) in (YAML_DICT_TYPE, ConfigLayer):
+        return ConfigLayer(value)
+    if type(value) is YAML_LIST_TYPE:
+        result = YAML_LIST_TYPE(_overlay(item) for item in value)
+        value.copy_attributes(result)
+        return result
+    return value
+
+
+def _flatten(value):
+    """
+    Return `YAML` node without any overlays
+    """
+    if type(value) is ConfigLayer:
+        return value.flatten()
+    if type(value) is YAML_LIST_TYPE and any(type(item) in (ConfigLayer, YAML_LIST_TYPE) for item in value):
+        result = YAML_LIST_TYPE(_flatten(item) for item in value)
+        value.copy_attributes(result)
+        return result
+    return value
+
 
 class ConfigWrapper:
     INITIALIZED = '_initialised'
+    CHILDREN = '_children'
 
     """
     Class to simplify access to `YAML` configuration object
@@ -48,7 +220,7 @@ class ConfigWrapper:
             If root is not `YAML` dictionary or list then return its original value otherwise return root wrapped in
             `ConfigWraper`.
         """
-        if type(root) not in (YAML_DICT_TYPE, YAML_LIST_TYPE):
+        if type(root) not in (YAML_DICT_TYPE, YAML_LIST_TYPE, ConfigLayer):
             if formatter and type(root) is str and '{' in root:
                 root = formatter(root)
             return root
@@ -69,6 +241,8 @@ class ConfigWrapper:
         self._root = root
         self.path = path
         self.formatter = formatter
+        # wrappers of nested dictionaries and lists reused by following accesses
+        self._children = {}
 
         # special attribute to mark initialized object have to be set last
         setattr(self, self.INITIALIZED, True)
@@ -84,6 +258,9 @@ class ConfigWrapper:
             if key == self.INITIALIZED:
                 # attribute which marks object initialization have to be set last
                 continue
+            if key == self.CHILDREN:
+                # wrappers of copied nodes are created again on access
+                value = {}
             setattr(result, key, copy.deepcopy(value, memo))
         # mark initialized object
         setattr(result, result.INITIALIZED, True)
@@ -94,6 +271,7 @@ class ConfigWrapper:
         Delete attribute from configuration
         """
         del self._root[item]
+        self._children.pop(item, None)
 
     def __setattr__(self, key, value):
         """
@@ -107,6 +285,7 @@ class ConfigWrapper:
             super().__setattr__(key, value)
         else:
             self._root[key] = value
+            self._children.pop(key, None)
 
     def is_dict(self) -> bool:
         """
@@ -115,7 +294,7 @@ class ConfigWrapper:
         :return:
             True when root is `YAML` dictionary
         """
-        return type(self._root) is YAML_DICT_TYPE
+        return type(self._root) in (YAML_DICT_TYPE, ConfigLayer)
 
     def is_list(self) -> bool:
         """
@@ -146,6 +325,30 @@ class ConfigWrapper:
         """
         return attribute if not self.path else '.'.join((self.path, attribute))
 
+    def _wrap(self, key, value):
+        """
+        Return value of child node wrapped in ConfigWrapper
+
+        Wrapper of nested dictionary or list is created only once and it is reused until the node is replaced.
+
+        :param key:
+            The name of attribute or list index.
+        :param value:
+            Value of child node.
+        :return:
+            ConfigWrapper object or basic type when value is not `YAML` dictionary or list.
+        """
+        if type(value) not in (YAML_DICT_TYPE, YAML_LIST_TYPE, ConfigLayer):
+            if self.formatter and type(value) is str and '{' in value:
+                value = self.formatter(value)
+            return value
+        child = self._children.get(key)
+        if child is None or child._root is not value or child.formatter is not self.formatter:
+            path = self._join_attribute(key) if self.is_dict() else '{}[{}]'.format(self.path, key)
+            child = ConfigWrapper(value, path=path, formatter=self.formatter)
+            self._children[key] = child
+        return child
+
     def __getattr__(self, item: str):
         """
         Access to dictionary key with object attribute
@@ -158,7 +361,7 @@ class ConfigWrapper:
         if self.is_dict():
             result = self._root.get(item)
             if result is not None:
-                return ConfigWrapper(result, path=self._join_attribute(item), formatter=self.formatter)
+                return self._wrap(item, result)
         raise AttributeError("Configuration '{}' has no attribute '{}'".format(self.path, item))
 
     def __getitem__(self, item):
@@ -170,21 +373,17 @@ class ConfigWrapper:
         :return:
             ConfigWrapper object with value get from `YAML` dictionary or list.
         """
-        result = None
-        path = None
         if self.is_dict():
             result = self._root.get(item)
             if result is None:
                 raise KeyError("Configuration '{}' has no attribute '{}'".format(self.path, item))
-            path = self._join_attribute(item)
         elif type(item) is not int:
             raise TypeError('list indices must be integers, not {}'.format(str(type(item))))
         elif item < len(self._root):
             result = self._root[item]
-            path = '{}[{}]'.format(self.path, item)
         else:
             raise IndexError("Configuration '{}' index out of range".format(self.path))
-        return ConfigWrapper(result, path=path, formatter=self.formatter)
+        return self._wrap(item, result)
 
     def __iter__(self):
         """
@@ -193,7 +392,9 @@ class ConfigWrapper:
         :return:
             Items are objects ConfigWrapper or basic types when value is not `YAML` dictionary or list.
         """
-        return (ConfigWrapper(value, formatter=self.formatter) for value in self._root)
+        if self.is_dict():
+            return (ConfigWrapper(key, formatter=self.formatter) for key in self._root)
+        return (self._wrap(index, value) for index, value in enumerate(self._root))
 
     def __contains__(self, item):
         """
@@ -218,7 +419,7 @@ class ConfigWrapper:
             Value of item or default value when item is not set.
         """
         value = self._root[item] if item in self._root else None
-        return ConfigWrapper(value, formatter=self.formatter) if value is not None else default
+        return self._wrap(item, value) if value is not None else default
 
     def get(self, path, default=None):
         """
@@ -234,7 +435,7 @@ class ConfigWrapper:
         if not path:
             raise AttributeError("Missing path to the configuration attrigute")
         current = self
-        for item in path.split('.'):
+        for item in _split_path(path):
             current = current.get_item(item)
             if current is None:
                 current = default
@@ -256,7 +457,7 @@ class ConfigWrapper:
             raise AttributeError("Missing path to the configuration attrigute")
         previous = self
         current = default
-        items = iter(path.split('.'))
+        items = iter(_split_path(path))
         for item in items:
             current = previous.get_item(item)
             if current is None:
@@ -285,7 +486,7 @@ class ConfigWrapper:
             Items are pairs where is contain key and value.
         """
         pairs = self._root.items() if self.is_dict() else enumerate(self._root)
-        return ((key, ConfigWrapper(value, formatter=self.formatter)) for key, value in pairs)
+        return ((key, self._wrap(key, value)) for key, value in pairs)
 
     def _merge(self, attribute, value):
         """
@@ -297,19 +498,19 @@ class ConfigWrapper:
             Value of attribute for overloading.
         """
         def merge_type(root_value, value):
-            return type(value) is ConfigWrapper and type(root_value._root) is type(value._root)
+            return type(value) is ConfigWrapper and root_value.is_dict() == value.is_dict()
 
         root_value = self.get(attribute)
         if not root_value or not merge_type(root_value, value):
-            # if attribute does not exist or has different type then simply copy/override this attribute
+            # if attribute does not exist or has different type then simply overlay/override this attribute
             if type(value) is ConfigWrapper:
                 value = value._root
-            setattr(self, attribute, copy.deepcopy(value))
+            setattr(self, attribute, _overlay(value))
             return
         # source and destination attribute can be merged
-        if type(root_value._root) is YAML_LIST_TYPE:
+        if root_value.is_list():
             # lists are replaced
-            setattr(self, attribute, copy.deepcopy(value._root))
+            setattr(self, attribute, _overlay(value._root))
             return
         # dictionary is recursively merged
         for next_attribute, next_value in value.items():
@@ -327,6 +528,18 @@ class ConfigWrapper:
         for attribute, value in config.items():
             self._merge(attribute, value)
 
+    def overlay(self):
+        """
+        Create copy-on-write configuration on top of the current one
+
+        Changes of the new configuration are not visible in the current one and the current configuration has not to be
+        modified while the overlay is used.
+
+        :return:
+            ConfigWrapper object with new configuration layer.
+        """
+        return ConfigWrapper(_overlay(self._root), path=self.path, formatter=self.formatter)
+
     def dump(self, stream):
         """
         Dump current configuration to the opened stream
@@ -336,7 +549,7 @@ class ConfigWrapper:
         :param stream:
             Opened stream for writing.
         """
-        yaml.dump(self._root, stream=stream, Dumper=yaml.RoundTripDumper)
+        yaml.dump(_flatten(self._root), stream=stream, Dumper=yaml.RoundTripDumper)
 
 
 class ListWalker:
@@ -386,11 +599,25 @@ class ListWalker:
         yield from self._get_list(self._list_name)
 
 
+def _get_mirror_name(uri):
+    """
+    Return relative path of mirror for remote repository
+
+    The path is derived from URI so the mirror is not shared by different repositories when location alias changes.
+    """
+    # strip scheme and user name and convert SCP-like syntax 'host:path' to 'host/path'
+    path = re.sub(r'^[\w+.-]+://', '', uri)
+    path = re.sub(r'^[^@/]*@', '', path).replace(':', '/')
+    return os.path.join(*(part for part in path.split('/') if part not in ('', '.', '..')))
+
+
 class RemoteWalker:
     """
     Iterator class for access remote repositories in configuration file
     """
-    Remote = namedtuple('Remote', ['name', 'uri', 'branch', 'fetch'])
+    Remote = namedtuple('Remote', ['name', 'uri', 'branch', 'fetch', 'depth', 'filter', 'reference'])
+    # clone options are optional
+    Remote.__new__.__defaults__ = (None, None, None)
 
     def __init__(self, remote, platform):
         """
@@ -407,19 +634,27 @@ class RemoteWalker:
         self._branch = remote.get('branch', 'master')
         self._fetch = remote.get('fetch', 'yes')
         self._fetch_force = remote.fetch_always == 'yes'
+        # default clone options
+        self._depth = remote.get('depth', None)
+        self._filter = remote.get('filter', None)
+        self._reference = remote.get('reference', None)
 
     def __iter__(self):
         """
         Return generator object as an iterator
 
         :return:
-            Items are named tuples with `name`, `uri`, `branch` and `fetch` attribute.
+            Items are named tuples with `name`, `uri`, `branch` and `fetch` attribute and with clone options `depth`,
+            `filter` and `reference` path to the mirror of the repository.
         """
         for name, repo in self.repos.items():
             remote_attributes = {
                 'location': repo.get('location', self._location),
                 'project': repo.get('project', None),
-                'branch': repo.get('branch', self._branch)
+                'branch': repo.get('branch', self._branch),
+                'depth': repo.get('depth', self._depth),
+                'filter': repo.get('filter', self._filter),
+                'reference': repo.get('reference', self._reference)
             }
 
             match = repo.get('match', None)
@@ -442,20 +677,139 @@ class RemoteWalker:
             server = self._aliases[location]
             uri = '{}/{}'.format(server, project)
             fetch = self._fetch_force or repo.get('fetch', self._fetch) == 'yes'
-            yield self.Remote(name, uri, branch, fetch)
 
+            reference = remote_attributes['reference']
+            if reference and reference != 'no':
+                # mirrors of all repositories are stored in one directory shared by all build directories
+                reference = os.path.join(os.path.abspath(os.path.expanduser(reference)), _get_mirror_name(uri))
+            else:
+                reference = None
+
+            yield self.Remote(name, uri, branch, fetch,
+                              remote_attributes['depth'], remote_attributes['filter'], reference)
+
+
+def _compile_config(root):
+    """
+    Convert `YAML` tree to plain objects which can be serialized by `marshal`
 
-def load_config(path: str):
+    Dictionaries are converted to tuples of key-value pairs to keep the order of attributes.
+    """
+    if isinstance(root, dict):
+        return tuple((_compile_config(key), _compile_config(value)) for key, value in root.items())
+    if isinstance(root, list):
+        return [_compile_config(value) for value in root]
+    for scalar_type in (bool, int, float, str):
+        if isinstance(root, scalar_type):
+            # scalars of round-trip loader are subclasses of basic types
+            return scalar_type(root)
+    return root
+
+
+def _decompile_config(root):
+    """
+    Convert plain objects from `_compile_config` back to `YAML` tree
+    """
+    if type(root) is tuple:
+        return YAML_DICT_TYPE((key, _decompile_config(value)) for key, value in root)
+    if type(root) is list:
+        return YAML_LIST_TYPE(_decompile_config(value) for value in root)
+    return root
+
+
+def _get_config_cache_path(path: str):
+    """
+    Return path to compiled configuration or None when caching is not supported
+    """
+    cache_tag = sys.implementation.cache_tag
+    if not cache_tag:
+        return None
+    config_dir, config_name = os.path.split(os.path.abspath(path))
+    return os.path.join(config_dir, CONFIG_CACHE_DIR, '{}.{}.marshal'.format(config_name, cache_tag))
+
+
+def _load_config_cache(cache_path: str, stat, content: bytes):
+    """
+    Load compiled configuration when it corresponds to the configuration file
+
+    The cache is valid when modification time and size of the file is the same. When only the modification time
+    differs then the content hash of the file is compared.
+
+    :param cache_path:
+        Path to compiled configuration.
+    :param stat:
+        Status of the configuration file.
+    :param content:
+        Content of the configuration file.
+    :return:
+        Pair of compiled configuration or None and flag if the cache has to be updated.
+    """
+    try:
+        with open(cache_path, 'rb') as cache_file:
+            version, mtime, size, digest, root = marshal.load(cache_file)
+    except (OSError, EOFError, ValueError, TypeError):
+        return None, True
+    if version != CONFIG_CACHE_VERSION or size != stat.st_size:
+        return None, True
+    if mtime != stat.st_mtime_ns:
+        # the file could be touched without modification
+        if hashlib.sha256(content).hexdigest() != digest:
+            return None, True
+        return root, True
+    return root, False
+
+
+def _save_config_cache(cache_path: str, stat, digest: str, root):
+    """
+    Store compiled configuration next to the configuration file
+
+    Failure is silently ignored because the cache is only an optimization.
+    """
+    try:
+        data = marshal.dumps((CONFIG_CACHE_VERSION, stat.st_mtime_ns, stat.st_size, digest, root))
+        cache_dir = os.path.dirname(cache_path)
+        os.makedirs(cache_dir, exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=cache_dir, delete=False) as cache_file:
+            cache_file.write(data)
+        os.replace(cache_file.name, cache_path)
+    except (OSError, ValueError):
+        pass
+
+
+def _load_compiled_config(path: str):
+    """
+    Load configuration file from cache or parse it and update the cache
+    """
+    with open(path, 'rb') as ymlfile:
+        stat = os.fstat(ymlfile.fileno())
+        content = ymlfile.read()
+
+    cache_path = _get_config_cache_path(path)
+    root, update = _load_config_cache(cache_path, stat, content) if cache_path else (None, False)
+    if root is None:
+        root = _compile_config(yaml.load(content.decode(), Loader=yaml.RoundTripLoader))
+    if update:
+        _save_config_cache(cache_path, stat, hashlib.sha256(content).hexdigest(), root)
+    return _decompile_config(root)
+
+
+def load_config(path: str, round_trip: bool=False):
     """
     Load and return configuration file
 
     :param path:
         Path to configuration file in `YAML` format.
+    :param round_trip:
+        Preserve comments and formatting of the file for later dump. Otherwise the configuration is loaded from
+        compiled cache when the file has not been changed.
     :return:
         ConfigWrapper object used for easier access to configuration attributes.
     """
     root = YAML_DICT_TYPE()
     if path:
-        with open(path, 'r') as ymlfile:
-            root = yaml.load(ymlfile, Loader=yaml.RoundTripLoader)
+        if round_trip:
+            with open(path, 'r') as ymlfile:
+                root = yaml.load(ymlfile, Loader=yaml.RoundTripLoader)
+        else:
+            root = _load_compiled_config(path)
     return ConfigWrapper(root)
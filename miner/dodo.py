@@ -63,7 +63,10 @@ def task_checkout():
     Task responsible for switching all repositories to requested branch or commit
     """
     for checkout_repo in builder.checkout_repos_doit():
-        yield _get_sub_task(None, checkout_repo, ['clone'])
+        task = _get_sub_task(None, checkout_repo)
+        # repository can be checked out right after it is cloned without waiting for other ones
+        task['task_dep'] = ['clone:{}'.format(task['name'])]
+        yield task
 
 
 def task_prepare():
@@ -73,15 +76,21 @@ def task_prepare():
     yield _get_sub_task('feeds_conf', builder.prepare_feeds_conf_doit(), ['checkout'])
     yield _get_sub_task('feeds_update', builder.prepare_feeds_update_doit(), ['prepare:feeds_conf'])
 
+    # feeds are installed one by one because they modify the same LEDE directories
     feeds_tasks = []
+    previous_task = 'prepare:feeds_update'
     for prepare_feeds in builder.prepare_feeds_doit():
-        task = _get_sub_task(None, prepare_feeds, ['prepare:feeds_update'])
+        task = _get_sub_task(None, prepare_feeds, [previous_task])
         task['name'] = 'feeds_install:{}'.format(task['name'])
-        feeds_tasks.append('prepare:{}'.format(task['name']))
+        previous_task = 'prepare:{}'.format(task['name'])
+        feeds_tasks.append(previous_task)
         yield task
 
     yield _get_sub_task('default_config', builder.prepare_default_config_doit(), feeds_tasks)
     yield _get_sub_task('config', builder.prepare_config_doit(), ['prepare:default_config'])
 
+    previous_task = 'prepare:config'
     for prepare_key in builder.prepare_keys_doit():
-        yield _get_sub_task(None, prepare_key, ['prepare:config'])
+        task = _get_sub_task(None, prepare_key, [previous_task])
+        previous_task = 'prepare:{}'.format(task['name'])
+        yield task
@@ -16,13 +16,28 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import logging
+import struct
+import csv
+import io
+import os
+import zlib
+
+from collections import OrderedDict
+from ruamel import yaml
 
 import miner.hwid as hwid
 
+from miner.config import ConfigWrapper
+
 MINER_FIRMWARE = 'firmware'
 MINER_ENV_SIZE = 0x20000
 MINER_CFG_SIZE = 0x20000
 
+# U-Boot environment image with CRC32 and flag byte of redundant environment
+ENV_CRC = struct.Struct('<I')
+ENV_FLAG_ACTIVE = 1
+ENV_PAD_BYTE = 0
+
 # variables for miner NAND configuration
 NET_MAC = 'ethaddr'
 NET_IP = 'net_ip'
@@ -58,6 +73,29 @@ MINER_CFG_INPUT = [
     (MINER_POOL_PASS, 'miner.pool.pass', '')
 ]
 
+# columns of miner inventory with corresponding configuration paths
+INVENTORY_COLUMNS = {
+    'mac': 'net.mac',
+    'hostname': 'net.hostname',
+    'ip': 'net.ip',
+    'mask': 'net.mask',
+    'gateway': 'net.gateway',
+    'dns_servers': 'net.dns_servers',
+    'freq': 'miner.hw.freq',
+    'voltage': 'miner.hw.voltage',
+    'fixed_freq': 'miner.hw.fixed_freq',
+    'pool_host': 'miner.pool.host',
+    'pool_port': 'miner.pool.port',
+    'pool_user': 'miner.pool.user',
+    'pool_pass': 'miner.pool.pass'
+}
+
+# attributes which are unique for each miner and which are not shared from the configuration
+MINER_CFG_UNIQUE = (NET_MAC, NET_IP, NET_HOSTNAME, MINER_HWID)
+
+MINER_CFG_INPUT_NAME = 'miner_cfg.txt'
+MINER_CFG_IMAGE_NAME = 'miner_cfg.bin'
+
 
 def write_miner_cfg_input(config, stream, excluded=None, use_default=True):
     """
@@ -83,10 +121,200 @@ def write_miner_cfg_input(config, stream, excluded=None, use_default=True):
             value = default if not callable(default) else default()
         if value:
             # attributes with empty value are completely omitted
-            if type(value) not in [str, int]:
-                if type(value) is bool:
-                    value = str(value).lower()
-                elif value.is_list():
-                    value = ','.join(value)
+            if type(value) is bool:
+                value = str(value).lower()
+            elif type(value) is list or (isinstance(value, ConfigWrapper) and value.is_list()):
+                value = ','.join(str(item) for item in value)
             stream.write('{}={}\n'.format(name, value).encode())
     return True
+
+
+def create_env_image(env_input: bytes, size: int, redundant: bool=True, pad_byte: int=ENV_PAD_BYTE) -> bytes:
+    """
+    Create U-Boot environment image from text input
+
+    The output is the same as the output of U-Boot utility `mkenvimage -r -p 0 -s <size>`. The input contains one
+    variable 'name=value' per line. Empty lines and lines starting with '#' are skipped and a backslash at the end
+    of line continues the value on the next line.
+
+    :param env_input:
+        Text input with environment variables.
+    :param size:
+        Size of the whole environment image.
+    :param redundant:
+        Add flag byte used by redundant environment.
+    :param pad_byte:
+        Value of bytes which fill the rest of the image.
+    :return:
+        Environment image with CRC32 of the data.
+    """
+    header_size = ENV_CRC.size + (1 if redundant else 0)
+    data_size = size - header_size
+    env = bytearray()
+    pos = 0
+    # the parser follows `mkenvimage` byte by byte including its handling of edge cases
+    while pos < len(env_input) and len(env) < data_size - 1:
+        char = env_input[pos]
+        line_start = pos == 0 or env_input[pos - 1] == ord('\n')
+        if char == ord('\n'):
+            if line_start:
+                # skip empty lines
+                pass
+            elif env_input[pos - 1] == ord('\\'):
+                # embedded new line in a variable replaces the backslash
+                env[-1] = char
+            else:
+                # end of a variable
+                env.append(0)
+        elif char == ord('#') and line_start:
+            # skip comment up to the end of line
+            end = env_input.find(b'\n', pos)
+            pos = len(env_input) if end < 0 else end
+        else:
+            env.append(char)
+        pos += 1
+    if pos < len(env_input):
+        raise ValueError("The environment input is too large for the target environment storage")
+    # the last variable is terminated and the environment ends with double terminator regardless of padding
+    if env and env[-1] != 0:
+        env.append(0)
+        if len(env) >= data_size:
+            raise ValueError("The environment input is too large for the target environment storage")
+    env.append(0)
+    data = bytes(env) + bytes([pad_byte]) * (data_size - len(env))
+    header = ENV_CRC.pack(zlib.crc32(data))
+    if redundant:
+        header += bytes([ENV_FLAG_ACTIVE])
+    return header + data
+
+
+def parse_env_image(image: bytes, redundant: bool=True) -> OrderedDict:
+    """
+    Parse U-Boot environment image
+
+    :param image:
+        Environment image created by `create_env_image` or by U-Boot.
+    :param redundant:
+        Image contains flag byte used by redundant environment.
+    :return:
+        Ordered dictionary with environment variables.
+    """
+    header_size = ENV_CRC.size + (1 if redundant else 0)
+    data = image[header_size:]
+    crc, = ENV_CRC.unpack_from(image)
+    if crc != zlib.crc32(data):
+        raise ValueError("Bad CRC of the environment image")
+    env = OrderedDict()
+    for variable in data.split(b'\0'):
+        if not variable:
+            # double terminator marks the end of the environment
+            break
+        name, _, value = variable.decode().partition('=')
+        env[name] = value
+    return env
+
+
+def create_miner_cfg_image(config, excluded=None, use_default=True):
+    """
+    Create miner configuration environment image for NAND partition 'miner_cfg'
+
+    :param config:
+        Configuration for bOS NAND environment.
+    :param excluded:
+        Dictionary with excluded attributes.
+    :param use_default:
+        Use default values for missing configuration.
+    :return:
+        Environment image or None when the configuration is not complete.
+    """
+    miner_cfg_input = io.BytesIO()
+    if not write_miner_cfg_input(config, miner_cfg_input, excluded, use_default):
+        return None
+    return create_env_image(miner_cfg_input.getvalue(), MINER_CFG_SIZE)
+
+
+def get_miner_cfg_defaults(config) -> dict:
+    """
+    Return miner configuration shared by all miners in the inventory
+
+    MAC address, IP address, hostname and HW identifier are unique for each miner so they are not included.
+
+    :param config:
+        Configuration for bOS NAND environment.
+    :return:
+        Dictionary with configuration paths and plain values.
+    """
+    defaults = {}
+    for name, path, _ in MINER_CFG_INPUT:
+        if name in MINER_CFG_UNIQUE:
+            continue
+        value = config.get(path)
+        if value is not None:
+            defaults[path] = list(value) if isinstance(value, ConfigWrapper) and value.is_list() else value
+    return defaults
+
+
+def load_inventory(path: str) -> list:
+    """
+    Load inventory of miners from CSV or YAML file
+
+    CSV file has a header with column names and YAML file contains a list of dictionaries with the same keys. The keys
+    are names from `INVENTORY_COLUMNS` or full configuration paths. DNS servers in CSV are separated by white space.
+    All YAML scalars are loaded as strings so values like voltage '0706' keep their leading zeros.
+
+    :param path:
+        Path to inventory file.
+    :return:
+        List of dictionaries with configuration paths and values for each miner.
+    """
+    with open(path, 'r') as inventory_file:
+        if os.path.splitext(path)[1] in ('.yml', '.yaml'):
+            rows = yaml.load(inventory_file, Loader=yaml.BaseLoader) or []
+        else:
+            rows = list(csv.DictReader(inventory_file))
+
+    miners = []
+    for row in rows:
+        miner_config = {}
+        for key, value in row.items():
+            if value is None or value == '':
+                continue
+            path = INVENTORY_COLUMNS.get(key, key)
+            if path == 'net.dns_servers' and type(value) is str:
+                value = value.split()
+            miner_config[path] = value
+        miners.append(miner_config)
+    return miners
+
+
+def get_miner_name(miner_config: dict) -> str:
+    """
+    Return name of miner used for its output directory
+    """
+    return miner_config.get('net.hostname') or miner_config['net.mac'].replace(':', '').lower()
+
+
+def write_miner_cfg_files(miner_config: dict, target_dir: str) -> bool:
+    """
+    Write miner configuration input and environment image for one miner of the inventory
+
+    The HW identifier is generated for each miner unless it is specified in the inventory.
+
+    :param miner_config:
+        Dictionary with configuration paths and values.
+    :param target_dir:
+        Path to directory where the files are created.
+    :return:
+        False when the configuration is not complete.
+    """
+    miner_cfg_input = io.BytesIO()
+    if not write_miner_cfg_input(miner_config, miner_cfg_input):
+        return False
+    image = create_env_image(miner_cfg_input.getvalue(), MINER_CFG_SIZE)
+
+    os.makedirs(target_dir, exist_ok=True)
+    with open(os.path.join(target_dir, MINER_CFG_INPUT_NAME), 'wb') as input_file:
+        input_file.write(miner_cfg_input.getvalue())
+    with open(os.path.join(target_dir, MINER_CFG_IMAGE_NAME), 'wb') as image_file:
+        image_file.write(image)
+    return True
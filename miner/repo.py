@@ -15,6 +15,7 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import logging
 import git
 
 from progress.bar import Bar
@@ -107,3 +108,52 @@ class RepoProgressPrinter(git.RemoteProgress):
         self._last_count = cur_count
         if stage_id & self.END:
             self._progress.finish()
+
+
+class RepoProgressLogger(git.RemoteProgress):
+    """
+    Progress of `git` operations logged line by line with the name of repository
+
+    It is used when more repositories are processed in parallel and progress bars would overwrite each other.
+    """
+    # minimal progress in percents between two log lines
+    STEP = 25
+
+    def __init__(self, name: str):
+        """
+        Initialize progress logger
+
+        :param name:
+            Name of repository used as a prefix of each line.
+        """
+        super().__init__()
+        self._name = name
+        self._logged = None
+
+    def update(self, op_code, cur_count, max_count=None, message=''):
+        """
+        Callback method called when `git` returns some progress
+
+        :param op_code:
+            Opcode with operation code and stage (BEGIN, END).
+        :param cur_count:
+            Current value of progress.
+        :param max_count:
+            Maximal value of progress.
+        :param message:
+            Message returned for some operation codes.
+        """
+        cur_count = int(cur_count)
+        op_msg = RepoProgressPrinter.operation.get(op_code & self.OP_MASK, 'Processing')
+        stage_id = op_code & self.STAGE_MASK
+        if stage_id & self.BEGIN:
+            self._logged = None
+        if max_count:
+            max_count = int(max_count)
+            percent = cur_count * 100 // max_count
+            if self._logged is None or percent >= self._logged + self.STEP or \
+                    (stage_id & self.END and percent != self._logged):
+                logging.info("{}: {} {}% ({}/{})".format(self._name, op_msg, percent, cur_count, max_count))
+                self._logged = percent
+        elif stage_id & self.END:
+            logging.info("{}: {} {}, done".format(self._name, op_msg, cur_count))
@@ -16,8 +16,12 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import paramiko
+import threading
 import logging
-import shutil
+import atexit
+import socket
+import gzip
+import time
 
 from contextlib import contextmanager
 from subprocess import CalledProcessError
@@ -26,6 +30,57 @@ from getpass import getpass
 
 logging.getLogger("paramiko").setLevel(logging.CRITICAL)
 
+# size of buffers used for file transfers
+BUFFER_SIZE = 1024 * 1024
+# maximal size of SFTP write request accepted by most servers
+SFTP_CHUNK_SIZE = 32768
+
+
+class TransferStats:
+    """
+    Throughput metrics of one file transfer
+    """
+    def __init__(self):
+        self.size = 0
+        self.start = time.monotonic()
+        self.elapsed = 0
+
+    @property
+    def rate(self) -> float:
+        """
+        Transfer rate in bytes per second
+        """
+        return self.size / self.elapsed if self.elapsed else 0
+
+    def __str__(self):
+        return '{:.1f} MiB in {:.1f}s ({:.2f} MiB/s)'.format(self.size / 2**20, self.elapsed, self.rate / 2**20)
+
+
+def copy_stream(src, dst, chunk_size: int=BUFFER_SIZE, size: int=None) -> TransferStats:
+    """
+    Copy data from file object to another one and measure throughput
+
+    :param src:
+        Source file object.
+    :param dst:
+        Destination file object.
+    :param chunk_size:
+        Size of one read and write.
+    :param size:
+        Optional number of bytes to copy instead of copying until end of file.
+    :return:
+        Statistics of the transfer.
+    """
+    stats = TransferStats()
+    while size is None or stats.size < size:
+        data = src.read(chunk_size if size is None else min(chunk_size, size - stats.size))
+        if not data:
+            break
+        dst.write(data)
+        stats.size += len(data)
+    stats.elapsed = time.monotonic() - stats.start
+    return stats
+
 
 class SSHError(Exception):
     """
@@ -38,23 +93,152 @@ class SSHError(Exception):
 class SSHClient(paramiko.SSHClient):
     """
     Class for support authentication without password and key
+
+    All authentication methods are negotiated on one transport. Methods allowed by the server are queried with
+    authentication 'none' and only those are tried so connection to the miner costs only one handshake.
     """
+    def __init__(self):
+        super().__init__()
+        # method which is tried first when it is allowed by the server
+        self.preferred_auth = None
+        # method which was successful in the last authentication
+        self.auth_method = None
+        # function returning new password when the current one is rejected
+        self.password_prompt = None
+
+    def _auth_password(self, username, password):
+        """
+        Authenticate with password and prompt the user for another one when it is rejected
+        """
+        while True:
+            if password is not None:
+                try:
+                    # fallback to keyboard-interactive authentication is done automatically
+                    self._transport.auth_password(username, password)
+                except paramiko.AuthenticationException:
+                    if not self._transport.is_active() or not self.password_prompt:
+                        raise
+                else:
+                    return
+            if not self.password_prompt:
+                raise paramiko.AuthenticationException('Password is required but it cannot be prompted')
+            password = self.password_prompt()
+
     def _auth(self, username, password, pkey, key_filenames, allow_agent,
               look_for_keys, gss_auth, gss_kex, gss_deleg_creds, gss_host, passphrase):
-        if password is None and not look_for_keys:
+        try:
             self._transport.auth_none(username)
+        except paramiko.BadAuthenticationType as e:
+            allowed_types = e.allowed_types
         else:
-            super()._auth(username, password, pkey, key_filenames, allow_agent,
-                          look_for_keys, gss_auth, gss_kex, gss_deleg_creds, gss_host, passphrase)
+            self.auth_method = 'none'
+            return
+
+        methods = []
+        if 'publickey' in allowed_types and (pkey or key_filenames or allow_agent or look_for_keys):
+            methods.append('publickey')
+        if 'password' in allowed_types or 'keyboard-interactive' in allowed_types:
+            methods.append('password')
+        if self.preferred_auth in methods:
+            methods.remove(self.preferred_auth)
+            methods.insert(0, self.preferred_auth)
+
+        for method in methods:
+            if method == 'publickey':
+                try:
+                    # try only keys without password on the same transport
+                    super()._auth(username, None, pkey, key_filenames, allow_agent,
+                                  look_for_keys, gss_auth, gss_kex, gss_deleg_creds, gss_host, passphrase)
+                except paramiko.SSHException:
+                    if not self._transport.is_active():
+                        raise
+                    continue
+            else:
+                self._auth_password(username, password)
+            self.auth_method = method
+            return
+        raise paramiko.AuthenticationException('No supported authentication method ({})'
+                                               .format(', '.join(allowed_types)))
+
+
+class SSHPool:
+    """
+    Pool of authenticated SSH connections shared by SSH managers
+
+    Connections are kept alive with keepalive packets and every command opens only a new channel on already
+    authenticated transport so repeated operations with the same host do not pay handshake and authentication again.
+    """
+    KEEPALIVE_INTERVAL = 15
+
+    def __init__(self, keepalive: int=KEEPALIVE_INTERVAL):
+        """
+        Initialize empty pool
+
+        :param keepalive:
+            Interval in seconds of keepalive packets sent to idle connections.
+        """
+        self._keepalive = keepalive
+        self._lock = threading.Lock()
+        self._host_locks = {}
+        self._clients = {}
+
+    @staticmethod
+    def _is_active(client) -> bool:
+        transport = client.get_transport()
+        return transport is not None and transport.is_active() and transport.is_authenticated()
+
+    def connect(self, manager):
+        """
+        Return connected SSH client for host and user of SSH manager
+
+        :param manager:
+            SSH manager which is used for connecting and authentication when there is no active connection in the pool.
+        :return:
+            Connected SSH client.
+        """
+        key = (manager.hostname, manager.username)
+        with self._lock:
+            host_lock = self._host_locks.setdefault(key, threading.Lock())
+        # connections to different hosts can be established in parallel
+        with host_lock:
+            client = self._clients.get(key)
+            if client is not None and self._is_active(client):
+                logging.debug("Reusing connection to '{}@{}'...".format(*key[::-1]))
+                return client
+            if client is not None:
+                client.close()
+            client = manager.connect()
+            client.get_transport().set_keepalive(self._keepalive)
+            self._clients[key] = client
+            return client
+
+    def close(self):
+        """
+        Close all connections in the pool
+        """
+        with self._lock:
+            clients = list(self._clients.values())
+            self._clients.clear()
+        for client in clients:
+            client.close()
+
+
+# process-wide pool of SSH connections
+DEFAULT_POOL = SSHPool()
+atexit.register(DEFAULT_POOL.close)
 
 
 class SSHManager:
     RemoteProcess = namedtuple('RemoteProcess', ['stdin', 'stdout', 'stderr'])
 
+    # successful authentication methods for all hosts
+    _auth_methods = {}
+
     """
     SSH Manager simplifies file operations and command running
     """
-    def __init__(self, hostname: str, username: str, password: str, load_host_keys: bool=True):
+    def __init__(self, hostname: str, username: str, password: str, load_host_keys: bool=True, pool: SSHPool=None,
+                 password_prompt=getpass):
         """
         Initialize SSH client with server name and information for authentication
 
@@ -66,11 +250,19 @@ class SSHManager:
             A password to use for authentication.
         :param load_host_keys:
             Load known host keys from the system to check connection.
+        :param pool:
+            Optional pool of SSH connections which keeps the connection open for another SSH manager.
+        :param password_prompt:
+            Function returning new password when the current one is rejected. None means that the authentication fails.
         """
         self._client = SSHClient()
         self._hostname = str(hostname)
         self._username = str(username)
-        self._password = str(password)
+        self._password = None if password is None else str(password)
+        self._pool = pool
+        self._password_prompt = password_prompt
+        # SFTP session is opened on demand and it is False when the server does not support it
+        self._sftp = None
 
         if load_host_keys:
             logging.debug("Loading system host keys...'")
@@ -83,41 +275,30 @@ class SSHManager:
         Connect to an SSH server and authenticate to it
         """
         logging.debug("Connecting to remote SSH server...'")
-        # at first try to login with ssh key
-        try:
-            self._client.connect(hostname=self._hostname, username=self._username, look_for_keys=True)
-        except paramiko.SSHException:
-            pass
-        else:
-            return self
-        # then try to login without password
-        try:
-            self._client.connect(hostname=self._hostname, username=self._username, password=None, look_for_keys=False)
-        except paramiko.BadAuthenticationType:
-            pass
-        else:
-            return self
-        # finally use use configured password
-        password = self._password
-        while True:
-            try:
-                self._client.close()
-                self._client.connect(hostname=self._hostname, username=self._username, password=password,
-                                     look_for_keys=False)
-            except paramiko.SSHException:
-                # login with ssh agent may fail so try another attempt without it
-                pass
-            else:
-                return self
-            try:
-                self._client.close()
-                self._client.connect(hostname=self._hostname, username=self._username, password=password,
-                                     look_for_keys=False, allow_agent=False)
-            except paramiko.SSHException:
-                # prompt the user when everything fails
-                password = getpass()
-            else:
-                break
+        self._client.preferred_auth = self._auth_methods.get(self._hostname)
+        self._client.password_prompt = self._password_prompt
+        self._client.connect(hostname=self._hostname, username=self._username, password=self._password)
+        # remember successful method to try it first next time
+        self._auth_methods[self._hostname] = self._client.auth_method
+        return self
+
+    @property
+    def hostname(self) -> str:
+        return self._hostname
+
+    @property
+    def username(self) -> str:
+        return self._username
+
+    def connect(self):
+        """
+        Connect to an SSH server and authenticate to it
+
+        :return:
+            Connected SSH client.
+        """
+        self._connect()
+        return self._client
 
     def __enter__(self):
         """
@@ -127,9 +308,15 @@ class SSHManager:
             SSH manager connected to the server.
         """
         try:
-            self._connect()
+            if self._pool:
+                self._client = self._pool.connect(self)
+            else:
+                self._connect()
         except paramiko.ssh_exception.NoValidConnectionsError as e:
             raise SSHError(e.strerror)
+        except socket.error as e:
+            # unresolved host name or connection timeout
+            raise SSHError("Cannot connect to '{}': {}".format(self._hostname, e))
         except paramiko.ssh_exception.BadHostKeyException as e:
             raise SSHError("The host key for '{}' has changed!\n"
                            "Remove incorrect key from '~/.ssh/known_hosts' or replace it with correct one"
@@ -138,9 +325,13 @@ class SSHManager:
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         """
-        Close connection with SSH server
+        Close connection with SSH server when it is not shared by the pool
         """
-        self._client.close()
+        if self._sftp:
+            self._sftp.close()
+            self._sftp = None
+        if not self._pool:
+            self._client.close()
 
     @staticmethod
     def _check_exit_status(cmd, stdout, stderr):
@@ -158,15 +349,32 @@ class SSHManager:
         if returncode != 0:
             raise CalledProcessError(returncode, cmd, stdout, stderr)
 
+    def _get_sftp(self):
+        """
+        Return SFTP session or None when the server does not have SFTP subsystem
+        """
+        if self._sftp is None:
+            try:
+                self._sftp = self._client.open_sftp()
+            except paramiko.SSHException:
+                logging.debug("SFTP is not supported by remote server, using exec channel...")
+                self._sftp = False
+        return self._sftp or None
+
     @contextmanager
-    def open(self, file: str, mode='r'):
+    def open(self, file: str, mode='r', compress: bool=False):
         """
         Open file and return a corresponding file object
 
+        Files opened for writing use pipelined SFTP when it is supported by the server. Otherwise, data are streamed
+        to exec channel with large buffer and optionally compressed on the fly.
+
         :param file:
             Pathname of the file to be opened.
         :param mode:
             An optional string that specifies the mode in which the file is opened.
+        :param compress:
+            Compress written data with gzip and decompress them on remote side. It cannot be used for reading.
         :return:
             File object.
         """
@@ -177,16 +385,36 @@ class SSHManager:
         }.get(mode, None)
         if direction is None:
             raise ValueError("Unsupported mode '{}'".format(mode))
+        if compress and mode == 'r':
+            raise ValueError("Compression is supported only for writing")
+
+        sftp = self._get_sftp() if mode != 'r' and not compress else None
+        if sftp:
+            logging.debug("Remotely opening file '{}' with mode '{}' over SFTP".format(file, mode))
+            with sftp.open(file, mode + 'b', bufsize=BUFFER_SIZE) as remote_file:
+                # do not wait for acknowledgement of each write request
+                remote_file.set_pipelined(True)
+                yield remote_file
+            return
 
         cmd = 'cat {}{}'.format(direction, file)
+        if compress:
+            cmd = 'gzip -dc {}{}'.format(direction, file)
 
         logging.debug("Remotely opening file '{}' with mode '{}'".format(file, mode))
-        stdin, stdout, stderr = self._client.exec_command(cmd)
+        stdin, stdout, stderr = self._client.exec_command(cmd, bufsize=BUFFER_SIZE)
         if mode == 'r':
             self._check_exit_status(cmd, stdout, stderr)
             yield stdout
+        elif compress:
+            with gzip.GzipFile(fileobj=stdin, mode='wb', mtime=0) as remote_file:
+                yield remote_file
+            stdin.flush()
+            stdin.channel.shutdown_write()
+            self._check_exit_status(cmd, stdout, stderr)
         else:
             yield stdin
+            stdin.flush()
             stdin.channel.shutdown_write()
             self._check_exit_status(cmd, stdout, stderr)
 
@@ -228,17 +456,36 @@ class SSHManager:
         self._check_exit_status(cmd, stdout, stderr)
         return stdout, stderr
 
-    def put(self, local_path, remote_path):
+    def run_batch(self, *commands):
         """
-        Copy local file to remote server without SFTP server
+        Run several system commands on remote system in one channel
+
+        Commands are run in sequence and the first failing command stops the batch.
+
+        :param commands:
+            List of commands where each command is a list of arguments or a string.
+        :return:
+            Standard output and standard error of the whole batch.
+        """
+        return self.run(' && '.join(self._get_cmd([command]) for command in commands))
+
+    def put(self, local_path, remote_path, compress: bool=False) -> TransferStats:
+        """
+        Copy local file to remote server
 
         :param local_path:
             Path to local file.
         :param remote_path:
             Path to remote file.
+        :param compress:
+            Compress data on the fly for slow links (it requires gzip on remote side).
+        :return:
+            Statistics of the transfer.
         """
-        with open(local_path, 'rb') as local, self.open(remote_path, 'w') as remote:
-            shutil.copyfileobj(local, remote)
+        with open(local_path, 'rb') as local, self.open(remote_path, 'w', compress) as remote:
+            stats = copy_stream(local, remote, SFTP_CHUNK_SIZE if self._sftp and not compress else BUFFER_SIZE)
+        logging.debug("Transferred '{}': {}".format(remote_path, stats))
+        return stats
 
     def open_sftp(self):
         """
@@ -0,0 +1,338 @@
+# Copyright (C) 2018  Braiins Systems s.r.o.
+#
+# This file is part of Braiins Build System (BB).
+#
+# BB is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import tempfile
+import hashlib
+import logging
+import shutil
+import fcntl
+import os
+
+from miner.compress import GzipReader, CHUNK_SIZE, touch_file, prune_dir
+
+# ioctl for cloning file content on copy-on-write file systems (Btrfs, XFS)
+FICLONE = 0x40049409
+
+
+def reflink(src_path: str, dst_path: str):
+    """
+    Create copy-on-write clone of the file
+
+    :param src_path:
+        Path to source file.
+    :param dst_path:
+        Path to new file.
+    """
+    with open(src_path, 'rb') as src_file, open(dst_path, 'wb') as dst_file:
+        try:
+            fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+        except OSError:
+            dst_file.close()
+            os.unlink(dst_path)
+            raise
+
+
+class BlobStore:
+    """
+    Content-addressed store of read-only files
+
+    Each unique content is stored only once and it is cloned to target directories. The store is used only on file
+    systems with copy-on-write clones because otherwise every file would be written twice. Hard links are never used
+    because the targets could be modified in place and corrupt the shared blob.
+    """
+    def __init__(self, store_dir: str):
+        """
+        Initialize store in a directory
+
+        :param store_dir:
+            Path to directory with stored files.
+        """
+        self._store_dir = store_dir
+        self._digests = {}
+        self._clone_supported = None
+
+    def is_clone_supported(self) -> bool:
+        """
+        Check if the file system of the store supports copy-on-write clones
+
+        The file system is probed only once.
+        """
+        if self._clone_supported is None:
+            os.makedirs(self._store_dir, exist_ok=True)
+            with tempfile.NamedTemporaryFile(dir=self._store_dir) as probe_file:
+                clone_path = probe_file.name + '.clone'
+                try:
+                    reflink(probe_file.name, clone_path)
+                except OSError:
+                    self._clone_supported = False
+                else:
+                    os.unlink(clone_path)
+                    self._clone_supported = True
+        return self._clone_supported
+
+    def get_digest(self, file_path: str) -> str:
+        """
+        Return hash of file content which is remembered until the file is modified
+        """
+        stat = os.stat(file_path)
+        key = (os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns, stat.st_ino)
+        digest = self._digests.get(key)
+        if not digest:
+            sha256 = hashlib.sha256()
+            with open(file_path, 'rb') as file:
+                for data in iter(lambda: file.read(CHUNK_SIZE), b''):
+                    sha256.update(data)
+            digest = sha256.hexdigest()
+            self._digests[key] = digest
+        return digest
+
+    def _get_path(self, digest: str) -> str:
+        return os.path.join(self._store_dir, digest[:2], digest)
+
+    def _commit(self, tmp_path: str, digest: str) -> str:
+        blob_path = self._get_path(digest)
+        if os.path.exists(blob_path):
+            os.unlink(tmp_path)
+            touch_file(blob_path)
+        else:
+            os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+            # blobs are shared by all targets so they must not be modified
+            os.chmod(tmp_path, 0o444)
+            os.replace(tmp_path, blob_path)
+        return blob_path
+
+    def add_file(self, file_path: str) -> str:
+        """
+        Store content of the file
+
+        :param file_path:
+            Path to source file.
+        :return:
+            Path to stored blob.
+        """
+        digest = self.get_digest(file_path)
+        blob_path = self._get_path(digest)
+        if os.path.exists(blob_path):
+            touch_file(blob_path)
+            return blob_path
+        os.makedirs(self._store_dir, exist_ok=True)
+        tmp_file = tempfile.NamedTemporaryFile(dir=self._store_dir, delete=False)
+        tmp_file.close()
+        try:
+            reflink(file_path, tmp_file.name)
+        except OSError:
+            shutil.copyfile(file_path, tmp_file.name)
+        return self._commit(tmp_file.name, digest)
+
+    def add_stream(self, stream) -> str:
+        """
+        Store content of the file object
+
+        :param stream:
+            Readable file object which is read from the current position to the end.
+        :return:
+            Path to stored blob.
+        """
+        os.makedirs(self._store_dir, exist_ok=True)
+        sha256 = hashlib.sha256()
+        with tempfile.NamedTemporaryFile(dir=self._store_dir, delete=False) as tmp_file:
+            for data in iter(lambda: stream.read(CHUNK_SIZE), b''):
+                sha256.update(data)
+                tmp_file.write(data)
+        return self._commit(tmp_file.name, sha256.hexdigest())
+
+    def prune(self, max_age: float) -> int:
+        """
+        Remove blobs which have not been used for a given time
+
+        :param max_age:
+            Maximal age of unused blob in seconds.
+        :return:
+            Number of removed blobs.
+        """
+        return prune_dir(self._store_dir, max_age)
+
+
+def is_copied(src_path: str, dst_path: str) -> bool:
+    """
+    Check if the destination file is up to date copy of the source file
+
+    Copies have the same size and modification time as their source so the content is not compared.
+    """
+    if not os.path.isfile(dst_path):
+        return False
+    src_stat = os.stat(src_path)
+    dst_stat = os.stat(dst_path)
+    if os.path.samestat(src_stat, dst_stat):
+        # hard link created by older version must be replaced by independent copy
+        return False
+    return src_stat.st_size == dst_stat.st_size and src_stat.st_mtime_ns == dst_stat.st_mtime_ns
+
+
+def copy_file(src_path: str, dst_path: str) -> bool:
+    """
+    Place independent copy of the file to destination path
+
+    It tries copy-on-write clone and then ordinary copy. The copy gets modification time of the source.
+
+    :param src_path:
+        Path to source file.
+    :param dst_path:
+        Path to destination file.
+    :return:
+        False when the destination is already up to date.
+    """
+    if is_copied(src_path, dst_path):
+        return False
+    if os.path.lexists(dst_path):
+        os.unlink(dst_path)
+    try:
+        reflink(src_path, dst_path)
+    except OSError:
+        # copy-on-write clones are not supported by the file system
+        shutil.copyfile(src_path, dst_path)
+    src_stat = os.stat(src_path)
+    os.utime(dst_path, ns=(src_stat.st_atime_ns, src_stat.st_mtime_ns))
+    return True
+
+
+def link_file(src_path: str, dst_path: str) -> bool:
+    """
+    Place hard link to the file to destination path
+
+    It must be used only for destinations which are never modified in place.
+
+    :param src_path:
+        Path to source file.
+    :param dst_path:
+        Path to destination file.
+    :return:
+        False when the destination is already up to date.
+    """
+    if os.path.isfile(dst_path) and os.path.samefile(src_path, dst_path):
+        return False
+    if os.path.lexists(dst_path):
+        os.unlink(dst_path)
+    try:
+        os.link(src_path, dst_path)
+    except OSError:
+        # hard links are not supported across file systems
+        return copy_file(src_path, dst_path)
+    return True
+
+
+class UploadManager:
+    """
+    Upload manager for deployment to local file system
+
+    On file systems with copy-on-write clones all files go through the content-addressed store so identical files are
+    stored only once. Otherwise files are copied directly to the target directory. Destination files which are already
+    up to date are skipped.
+    """
+    def __init__(self, target_dir: str, store: BlobStore, compress_cache, cache=None, hardlink: bool=False):
+        """
+        Initialize upload manager for target directory
+
+        :param target_dir:
+            Path to target directory.
+        :param store:
+            Content-addressed store of all uploaded files.
+        :param compress_cache:
+            Cache of compressed files.
+        :param cache:
+            Dictionary with paths of named files shared with other upload managers.
+        :param hardlink:
+            Hard link files to the target directory which is only read e.g. for archiving.
+        """
+        self._target_dir_prev = []
+        self._target_dir = target_dir
+        self._store = store
+        self._compress_cache = compress_cache
+        self._cache = cache if cache is not None else {}
+        self._place_file = link_file if hardlink else copy_file
+
+    def get_cache(self):
+        return self._cache
+
+    def push_dir(self, path):
+        self._target_dir_prev.append(self._target_dir)
+        self._target_dir = os.path.join(self._target_dir, path)
+        os.makedirs(self._target_dir, exist_ok=True)
+
+    def pop_dir(self):
+        self._target_dir = self._target_dir_prev.pop()
+
+    def _get_source(self, src, compress: bool, dst_path: str) -> str:
+        """
+        Return path to file with uploaded content
+
+        File objects are written directly to the destination when the store is not used.
+        """
+        use_store = self._store.is_clone_supported()
+        if type(src) is str:
+            src_path = self._compress_cache.get(src) if compress else src
+            return self._store.add_file(src_path) if use_store else src_path
+        if compress:
+            # the source file object is owned by the caller
+            src = GzipReader(src, closefd=False)
+        try:
+            if use_store:
+                return self._store.add_stream(src)
+            if os.path.lexists(dst_path):
+                os.unlink(dst_path)
+            with open(dst_path, 'wb') as dst_file:
+                shutil.copyfileobj(src, dst_file, CHUNK_SIZE)
+            return dst_path
+        finally:
+            if compress:
+                src.close()
+
+    def put(self, src, dst, compress=False, cache: str=None):
+        """
+        Upload file to the current target directory
+
+        :param src:
+            Path to source file or file object. It can be None when the file is taken from the named cache.
+        :param dst:
+            Name of destination file.
+        :param compress:
+            Compress file with gzip.
+        :param cache:
+            Name of the file in the cache shared with other upload managers.
+        :return:
+            False when the file is requested from the cache but it is not there.
+        """
+        dst_path = os.path.join(self._target_dir, dst)
+        written = False
+        if cache and not src:
+            src_path = self._cache.get(cache)
+            if not src_path:
+                # file is not found in cache
+                return False
+        else:
+            src_path = self._get_source(src, compress, dst_path)
+            written = src_path == dst_path
+            if cache:
+                self._cache[cache] = src_path
+
+        if written:
+            logging.info("Writing '{}' to '{}'...".format(dst, self._target_dir))
+        elif src_path != dst_path and self._place_file(src_path, dst_path):
+            logging.info("Copying '{}' to '{}'...".format(dst, self._target_dir))
+        else:
+            logging.info("Skipping up to date '{}' in '{}'...".format(dst, self._target_dir))
+        return True
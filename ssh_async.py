@@ -0,0 +1,325 @@
+# Copyright (C) 2018  Braiins Systems s.r.o.
+#
+# This file is part of Braiins Build System (BB).
+#
+# BB is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import itertools
+import asyncssh
+import asyncio
+import logging
+import time
+import os
+
+from subprocess import CalledProcessError
+from collections import namedtuple
+
+# the module does not depend on the miner package so it can be used by standalone tools without build dependencies
+
+logging.getLogger("asyncssh").setLevel(logging.CRITICAL)
+
+# size of buffers used for file transfers
+BUFFER_SIZE = 1024 * 1024
+
+
+class TransferStats:
+    """
+    Throughput metrics of one file transfer
+    """
+    def __init__(self):
+        self.size = 0
+        self.start = time.monotonic()
+        self.elapsed = 0
+
+    @property
+    def rate(self) -> float:
+        """
+        Transfer rate in bytes per second
+        """
+        return self.size / self.elapsed if self.elapsed else 0
+
+    def __str__(self):
+        return '{:.1f} MiB in {:.1f}s ({:.2f} MiB/s)'.format(self.size / 2**20, self.elapsed, self.rate / 2**20)
+
+
+class SSHError(Exception):
+    """
+    Wrapper for asyncssh exception.
+    """
+    def __init__(self, message):
+        super().__init__(message)
+
+
+async def try_password(host, port, username, password):
+    """
+    Connect to an SSH server and authenticate with one password
+
+    :return:
+        Connected SSH client connection.
+    """
+    conn, _ = await asyncssh.create_connection(None, host, port, username=username, password=password,
+                                               known_hosts=None)
+    return conn
+
+
+def _close_future(future):
+    """
+    Close connection of the password attempt which lost the race
+    """
+    if not future.cancelled() and not future.exception():
+        future.result().close()
+
+
+async def race_passwords(host, port, username, passwords, parallel: int=1):
+    """
+    Try passwords with bounded number of parallel connections
+
+    :param host:
+        The server to connect to.
+    :param port:
+        Port of the SSH server.
+    :param username:
+        The username to authenticate as.
+    :param passwords:
+        Iterable of passwords in order of priority. None means authentication without password.
+    :param parallel:
+        Maximal number of parallel connection attempts.
+    :return:
+        Pair of first successful connection and its password.
+    """
+    passwords = iter(passwords)
+    attempts = {}
+    last_error = None
+    try:
+        while True:
+            for password in itertools.islice(passwords, parallel - len(attempts)):
+                attempts[asyncio.ensure_future(try_password(host, port, username, password))] = password
+            if not attempts:
+                if last_error is None:
+                    # there is no password to try
+                    raise asyncssh.misc.DisconnectError(asyncssh.DISC_NO_MORE_AUTH_METHODS_AVAILABLE,
+                                                        'No password accepted by {}'.format(host))
+                raise last_error
+            done, _ = await asyncio.wait(attempts, return_when=asyncio.FIRST_COMPLETED)
+            result = None
+            for future in done:
+                password = attempts.pop(future)
+                try:
+                    conn = future.result()
+                except asyncssh.misc.DisconnectError as e:
+                    last_error = e
+                    continue
+                if result:
+                    conn.close()
+                else:
+                    result = conn, password
+            if result:
+                return result
+    finally:
+        # remaining attempts are not cancelled because it could leave half-open connections
+        for future in attempts:
+            future.add_done_callback(_close_future)
+
+
+class RemotePipe:
+    """
+    Asynchronous context manager for process running on remote system
+    """
+    def __init__(self, conn, cmd, check=True):
+        self._conn = conn
+        self._cmd = cmd
+        self._check = check
+        self._process = None
+
+    async def __aenter__(self):
+        self._process = await self._conn.create_process(self._cmd, encoding=None)
+        return AsyncSSHManager.RemoteProcess(self._process.stdin, self._process.stdout, self._process.stderr)
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        self._process.stdin.write_eof()
+        result = await self._process.wait()
+        if self._check and exc_type is None and result.exit_status != 0:
+            raise CalledProcessError(result.exit_status, self._cmd, result.stdout, result.stderr)
+
+
+class RemoteFile(RemotePipe):
+    """
+    Asynchronous context manager for file opened on remote system
+    """
+    def __init__(self, conn, cmd, mode):
+        super().__init__(conn, cmd)
+        self._mode = mode
+
+    async def __aenter__(self):
+        process = await super().__aenter__()
+        return process.stdout if self._mode == 'r' else process.stdin
+
+
+class AsyncSSHManager:
+    """
+    SSH Manager built on asyncio which can drive many remote hosts from one event loop
+
+    It provides the same operations as the blocking `miner.ssh.SSHManager`.
+    """
+    RemoteProcess = namedtuple('RemoteProcess', ['stdin', 'stdout', 'stderr'])
+
+    def __init__(self, hostname: str, username: str, password: str, port: int=22, passwords=()):
+        """
+        Initialize SSH client with server name and information for authentication
+
+        :param hostname:
+            The server to connect to.
+        :param username:
+            The username to authenticate as.
+        :param password:
+            A password to use for authentication. None means authentication without password.
+        :param port:
+            Port of the SSH server.
+        :param passwords:
+            Additional passwords which are tried when the first one is rejected.
+        """
+        self._hostname = str(hostname)
+        self._username = str(username)
+        self._password = None if password is None else str(password)
+        self._port = port
+        self._passwords = passwords
+        self._conn = None
+        self._sftp = None
+
+    async def __aenter__(self):
+        """
+        Connect to an SSH server and authenticate to it
+
+        :return:
+            SSH manager connected to the server.
+        """
+        logging.debug("Connecting to remote SSH server '{}'...".format(self._hostname))
+        passwords = [self._password] + [password for password in self._passwords if password != self._password]
+        try:
+            self._conn, _ = await race_passwords(self._hostname, self._port, self._username, passwords)
+        except (OSError, asyncssh.Error) as e:
+            raise SSHError("Cannot connect to '{}': {}".format(self._hostname, e))
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        """
+        Close connection with SSH server
+        """
+        if self._sftp:
+            self._sftp.exit()
+            self._sftp = None
+        self._conn.close()
+        await self._conn.wait_closed()
+
+    @staticmethod
+    def _get_cmd(args) -> str:
+        """
+        Return command string compatible with SSH client run
+        """
+        if type(args[0]) is list:
+            args = args[0]
+
+        return ' '.join(args)
+
+    def pipe(self, *args):
+        """
+        Context manager for running system command on remote system
+
+        :return:
+            RemoteProcess with stdin, stdout and stderr streams.
+        """
+        cmd = self._get_cmd(args)
+
+        logging.debug("Remotely running command '{}'...".format(cmd))
+        return RemotePipe(self._conn, cmd)
+
+    def open(self, file: str, mode='r'):
+        """
+        Open file and return a corresponding stream
+
+        :param file:
+            Pathname of the file to be opened.
+        :param mode:
+            An optional string that specifies the mode in which the file is opened.
+        :return:
+            Reader stream for mode 'r' and writer stream otherwise.
+        """
+        direction = {
+            'r': '<',
+            'w': '>',
+            'a': '>>'
+        }.get(mode, None)
+        if direction is None:
+            raise ValueError("Unsupported mode '{}'".format(mode))
+
+        logging.debug("Remotely opening file '{}' with mode '{}'".format(file, mode))
+        return RemoteFile(self._conn, 'cat {}{}'.format(direction, file), mode)
+
+    async def run(self, *args):
+        """
+        Run system command on remote system
+
+        :return:
+            Standard output and standard error of the command.
+        """
+        cmd = self._get_cmd(args)
+
+        logging.debug("Remotely running command '{}'...".format(cmd))
+        result = await self._conn.run(cmd)
+        if result.exit_status != 0:
+            raise CalledProcessError(result.exit_status, cmd, result.stdout, result.stderr)
+        return result.stdout, result.stderr
+
+    async def _get_sftp(self):
+        """
+        Return SFTP session or None when the server does not have SFTP subsystem
+        """
+        if self._sftp is None:
+            try:
+                self._sftp = await self._conn.start_sftp_client()
+            except asyncssh.Error:
+                logging.debug("SFTP is not supported by remote server, using exec channel...")
+                self._sftp = False
+        return self._sftp or None
+
+    async def put(self, local_path, remote_path) -> TransferStats:
+        """
+        Copy local file to remote server
+
+        :param local_path:
+            Path to local file.
+        :param remote_path:
+            Path to remote file.
+        :return:
+            Statistics of the transfer.
+        """
+        stats = TransferStats()
+        sftp = await self._get_sftp()
+        if sftp:
+            # SFTP client keeps several write requests in flight
+            await sftp.put(local_path, remote_path)
+            stats.size = os.path.getsize(local_path)
+        else:
+            with open(local_path, 'rb') as local:
+                async with self.open(remote_path, 'w') as remote:
+                    while True:
+                        data = local.read(BUFFER_SIZE)
+                        if not data:
+                            break
+                        remote.write(data)
+                        await remote.drain()
+                        stats.size += len(data)
+        stats.elapsed = time.monotonic() - stats.start
+        logging.debug("Transferred '{}': {}".format(remote_path, stats))
+        return stats